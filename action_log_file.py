@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import argparse
+from array import array
+from collections.abc import Sequence
+import mmap
+import struct
+import zlib
+
+from interfaces import ActionType
+import wire_format
+
+# Append-only action log file:
+#   header:      MAGIC and the format version
+#   records:     the length of the record payload (4 bytes) and its kind (1 byte), then the payload
+#   ACTION:      agent id, step, action type and flags, then the action message in the wire format (if it has one)
+#   CHECKPOINT:  the number of actions so far, and the CRC32 of the action records since the previous checkpoint
+# The writer flushes at every checkpoint, so a crashed run leaves a readable log up to its last complete record.
+MAGIC = b'ALOG'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('!4sB')
+
+RECORD_HEADER = struct.Struct('!IB')
+ACTION = struct.Struct('!16sdBB')
+CHECKPOINT = struct.Struct('!QI')
+
+RECORD_ACTION = 1
+RECORD_CHECKPOINT = 2
+
+# Flags of an action
+HAS_MSG = 0x01
+INT_STEP = 0x02
+
+
+def encode_action(entry) -> bytes:
+    agent_id, step, action_type, action_msg = entry
+    flags = (HAS_MSG if action_msg is not None else 0) | (INT_STEP if isinstance(step, int) else 0)
+    payload = ACTION.pack(wire_format.encode_id(agent_id), step, action_type.value, flags)
+    if action_msg is not None:
+        payload += wire_format.encode(action_msg)
+    return RECORD_HEADER.pack(len(payload), RECORD_ACTION) + payload
+
+def decode_action(view: memoryview, offset, length):
+    # The (agent_id, step, action_type, action_msg) entry of the action record whose payload is at the offset
+    agent_id, step, action_type, flags = ACTION.unpack_from(view, offset)
+    action_msg = None
+    if flags & HAS_MSG:
+        action_msg = wire_format.decode(view[offset + ACTION.size:offset + length])
+    return wire_format.decode_id(agent_id), int(step) if flags & INT_STEP else step, ActionType(action_type), action_msg
+
+
+class ActionLogWriter:
+    # Streams the action log of a run into a file, as the actions happen. Used as ctx.action_log (it has the append
+    # of a list), so the run never holds its log in memory
+
+    def __init__(self, path, checkpoint_every=1024):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION))
+        self.checkpoint_every = checkpoint_every
+        self.count = 0
+        self.crc = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Read back what was written so far. The file is mapped only while iterating
+        self.file.flush()
+        with ActionLogFile(self.path) as log:
+            yield from log
+
+    def append(self, entry):
+        record = encode_action(entry)
+        self.file.write(record)
+        self.crc = zlib.crc32(record, self.crc)
+        self.count += 1
+        if self.count % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file.write(RECORD_HEADER.pack(CHECKPOINT.size, RECORD_CHECKPOINT) + CHECKPOINT.pack(self.count, self.crc))
+        self.crc = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+
+class ActionLogFile(Sequence):
+    # A written action log, memory-mapped. Only the offsets of the actions are kept, and an action is decoded when it
+    # is accessed, so replaying a log costs memory per action and not per message.
+    # Checkpoints are verified when the file is opened. A record cut short at the end (a crashed writer) is ignored.
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+
+        magic, version = FILE_HEADER.unpack_from(self.view, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Not an action log file: {path}')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported action log format version: {version}')
+
+        # Offsets and lengths of the payloads of the actions
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.checkpoints = 0
+        self.scan()
+
+    def scan(self):
+        offset = FILE_HEADER.size
+        crc = 0
+        while offset + RECORD_HEADER.size <= len(self.view):
+            length, kind = RECORD_HEADER.unpack_from(self.view, offset)
+            payload = offset + RECORD_HEADER.size
+            if payload + length > len(self.view):
+                break
+
+            if kind == RECORD_ACTION:
+                self.offsets.append(payload)
+                self.lengths.append(length)
+                crc = zlib.crc32(self.view[offset:payload + length], crc)
+            elif kind == RECORD_CHECKPOINT:
+                count, checkpoint_crc = CHECKPOINT.unpack_from(self.view, payload)
+                if count != len(self.offsets) or checkpoint_crc != crc:
+                    raise ValueError(f'Corrupt action log: checkpoint {self.checkpoints + 1} does not match its actions')
+                self.checkpoints += 1
+                crc = 0
+            else:
+                raise ValueError(f'Corrupt action log: unknown record kind {kind} at {offset}')
+            offset = payload + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return decode_action(self.view, self.offsets[i], self.lengths[i])
+
+    def action_keys(self):
+        # (agent_id, action_type) of every action, without decoding the messages
+        for offset in self.offsets:
+            agent_id, _, action_type, _ = ACTION.unpack_from(self.view, offset)
+            yield wire_format.decode_id(agent_id), ActionType(action_type)
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_action_log(path, action_log, checkpoint_every=1024):
+    # Write a whole in-memory action log (e.g. one loaded from a pickle) to a file
+    writer = ActionLogWriter(path, checkpoint_every)
+    for entry in action_log:
+        writer.append(entry)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify an action log file and print its summary.')
+    parser.add_argument('path')
+    parser.add_argument('--actions', action='store_true', help='Also print every action')
+    args = parser.parse_args()
+
+    log = ActionLogFile(args.path)
+    print(f'Actions: {len(log)}, checkpoints: {log.checkpoints}, size: {len(log.mm)} bytes')
+    if args.actions:
+        for agent_id, step, action_type, action_msg in log:
+            print(f'{step}: {agent_id} {action_type}' + (f' ({action_msg})' if action_msg is not None else ''))
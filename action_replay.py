@@ -0,0 +1,88 @@
+from collections import defaultdict, deque
+
+from action_log_file import ActionLogFile
+from interfaces import ActionType
+
+
+START_ACTIONS = [ActionType.PAY_START, ActionType.GET_TOKENS_START, ActionType.CLIENT_TRANSFORM_START, ActionType.SERVER_TRANSFORM_START]
+
+
+class ActionLogReplay:
+    # Replays a recorded action log of (agent_id, step, action_type, action_msg) tuples.
+    # Actions are started in the recorded order through a cursor, and the finish of an action is matched through
+    # per (agent_id, action_type) queues of log positions, so every lookup is O(1) however long the log is.
+    # A log file (ActionLogFile) is replayed from its mapping, decoding only the entries that are looked at.
+
+    def __init__(self, action_log):
+        if isinstance(action_log, ActionLogFile):
+            self.entries = action_log
+            keys = action_log.action_keys()
+        else:
+            self.entries = list(action_log)
+            keys = ((agent_id, action_type) for agent_id, _, action_type, _ in self.entries)
+        self.consumed = bytearray(len(self.entries))
+        self.cursor = 0
+        self.remaining = len(self.entries)
+        # The entry at the cursor, kept since it is peeked at every step
+        self.peeked_at = -1
+        self.peeked = None
+
+        self.pending = defaultdict(deque)
+        for i, key in enumerate(keys):
+            self.pending[key].append(i)
+
+        # Progress metrics
+        self.started = 0
+        self.matched = 0
+
+    def __len__(self):
+        return self.remaining
+
+    def consume(self, i):
+        self.consumed[i] = 1
+        self.remaining -= 1
+        return self.entries[i]
+
+    def peek(self):
+        # The first action of the log that wasn't replayed yet
+        while self.cursor < len(self.entries) and self.consumed[self.cursor]:
+            self.cursor += 1
+        if self.cursor >= len(self.entries):
+            return None
+        if self.peeked_at != self.cursor:
+            self.peeked_at, self.peeked = self.cursor, self.entries[self.cursor]
+        return self.peeked
+
+    def pop_next(self):
+        entry = self.peek()
+        if entry is None:
+            return None
+
+        # The next action of the log is also the first one left in its own queue
+        self.pending[(entry[0], entry[2])].popleft()
+        if entry[2] in START_ACTIONS:
+            self.started += 1
+        return self.consume(self.cursor)
+
+    def pop_first(self, agent_id, action_type):
+        # Match the first action of the agent of the given type that wasn't replayed yet
+        positions = self.pending.get((agent_id, action_type))
+        if not positions:
+            return None
+
+        self.matched += 1
+        return self.consume(positions.popleft())
+
+    def remaining_entries(self):
+        return [entry for i, entry in enumerate(self.entries) if not self.consumed[i]]
+
+    def progress(self):
+        total = len(self.entries)
+        return {
+            'total': total,
+            'replayed': total - self.remaining,
+            'remaining': self.remaining,
+            'started': self.started,
+            'matched': self.matched,
+            'percent': 100.0 * (total - self.remaining) / total if total else 100.0,
+        }
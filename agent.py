@@ -1,23 +1,77 @@
 from abc import abstractmethod
-import copy
 from enum import Enum
-import random
 from typing import List, Optional
 import uuid
 from interfaces import ActionType, AgentRole, Message, MessageType, Token
-import simulation_state
+from simulation_state import SimulationContext
+from token_store import TokenStore
+from timers import BACKOFFS
+from upon_registry import UponRegistry
+
+START_ACTIONS = [ActionType.PAY_START, ActionType.GET_TOKENS_START, ActionType.CLIENT_TRANSFORM_START, ActionType.SERVER_TRANSFORM_START]
+FINISH_ACTIONS = [ActionType.PAY_FINISH, ActionType.GET_TOKENS_FINISH, ActionType.CLIENT_TRANSFORM_FINISH, ActionType.SERVER_TRANSFORM_FINISH]
+TRANSFORM_ACTIONS = [ActionType.CLIENT_TRANSFORM_START, ActionType.SERVER_TRANSFORM_START]
+# Actions that can start while other operations of the agent are in progress
+PIPELINED_ACTIONS = [ActionType.PAY_START, ActionType.GET_TOKENS_START]
+
+class Operation:
+    # An action of an agent that didn't finish yet: its message, when it was last sent and how long to wait for it
+    # before sending it again, and the upon waiting for its answers (telling who already answered it)
+
+    def __init__(self, id):
+        self.id = id
+        self.action_type = None
+        self.msg = None
+        self.timestamp = None
+        self.timeout = None
+        self.retry_attempt = 0
+        self.upon = None
+
+    def timeout_step(self):
+        # The step from which the operation is done again
+        return self.timestamp + self.timeout + 1
 
 class Agent:
-    def __init__(self, role: AgentRole, omission_rate=0):
+    def __init__(self, ctx: SimulationContext, role: AgentRole, omission_rate=0):
+        self.ctx = ctx
         self.omission_rate = float(omission_rate)
         self.tokens_db = None
         self.my_tokens = []
         self.role = role
-        self.upon_registry = []
-        self.id = simulation_state.IDS.pop()
-        self.during_action = False
+        self.upon_registry = UponRegistry()
+        self.id = ctx.id_provider.next_id()
         self.is_faulty = False
-        self.last_action_msg = None
+        # The operations in progress by their id (up to PIPELINE_DEPTH of them), and the ids given so far
+        self.operations = {}
+        self.op_counter = 0
+        # Tokens of PAY operations in progress, which other operations can't pay
+        self.tokens_in_flight = set()
+
+        # Per server, the sequence of its DB up to which we merged its changes
+        self.seen_db_seqs = {}
+        # The step at which a quorum of GET answers last brought our DB up to date (None: never), which bounds how
+        # stale our view of the tokens (and of every owner's tokens, from the owner index of the DB) is
+        self.refreshed_step = None
+
+    # True while an action is in progress
+    @property
+    def during_action(self):
+        return len(self.operations) > 0
+
+    def can_start_action(self):
+        # A transform runs alone, other actions are pipelined up to PIPELINE_DEPTH at once
+        if len(self.operations) >= self.ctx.PIPELINE_DEPTH:
+            return False
+        return not any(op.action_type in TRANSFORM_ACTIONS for op in self.operations.values())
+
+    def pipelined(self):
+        # With pipelining, GET_TOKENS carries the id of its operation (echoed by the answers) so answers of
+        # concurrent GETs aren't mixed
+        return self.ctx.PIPELINE_DEPTH > 1
+
+    def new_operation(self) -> Operation:
+        self.op_counter += 1
+        return Operation(self.op_counter)
 
     def set_omission_rate(self, omission_rate):
         self.omission_rate = omission_rate
@@ -25,106 +79,257 @@ class Agent:
         if omission_rate > 0:
             self.is_faulty = True
 
-    def set_tokens_db(self, tokens_db):
+    def set_tokens_db(self, tokens_db: TokenStore):
         self.tokens_db = tokens_db
+        self.my_tokens = tokens_db.tokens_of(self.id)
+
+    # Sequence number of the last change in my tokens DB
+    @property
+    def db_seq(self):
+        return self.tokens_db.seq
+
+    def update_token(self, token: Token):
+        self.tokens_db.set(token)
+
+    def learn_token(self, token: Token):
+        # Update the token if it is newer than ours
+        local = self.tokens_db.get(token.id)
+        if local is None or token.version > local.version:
+            self.update_token(token)
+
+    def merge_tokens(self, tokens_list):
+        self.merge_token_lists([tokens_list])
+
+    def merge_token_lists(self, token_lists):
+        # All the lists are reduced at once to the highest version of every token (the first of them on ties),
+        # then only those are checked
+        latest = {}
+        for tokens in token_lists:
+            for token in tokens:
+                best = latest.get(token.id)
+                if best is None or token.version > best.version:
+                    latest[token.id] = token
+        for token in latest.values():
+            self.learn_token(token)
+
+    def tokens_changed_since(self, seq):
+        return self.tokens_db.changed_since(seq)
+
+    def merge_get_tokens_answers(self, msgs: List[Message]):
+        # Answers hold only what changed since the last answer we merged from that server,
+        # so they are merged into the DB we already have
+        self.merge_token_lists([msg.content[0] for msg in msgs])
+        for msg in msgs:
+            db_seq = msg.content[1]
+            self.seen_db_seqs[msg.sender_id] = max(db_seq, self.seen_db_seqs.get(msg.sender_id, 0))
+        self.refreshed_step = self.ctx.step_counter
+
+    def db_is_fresh(self, max_age) -> bool:
+        # Whether our DB was brought up to date at most max_age steps ago (never with max_age None)
+        return max_age is not None and self.refreshed_step is not None and self.ctx.step_counter - self.refreshed_step <= max_age
+
+    @staticmethod
+    def get_pay_entries(content):
+        # PAY content is a single (token_id, buyer_id, new_version), or a list of them for a batched PAY
+        return content if isinstance(content, list) else [content]
+
+    @staticmethod
+    def get_pay_key(content):
+        # The (token_id, new_version) of a PAY, or a tuple of them for a batched PAY. It is the key of the ACK_PAY
+        # answering it (see upon_registry.UPON_KEYS), and tells its operation apart from the other PAYs of the client
+        if isinstance(content, list):
+            return tuple((token_id, new_version) for token_id, _, new_version in content)
+        token_id, _, new_version = content
+        return token_id, new_version
+
+    @staticmethod
+    def get_request_owner(content):
+        # GET_TOKENS content is (owner_id, seen_db_seqs) (and the operation id when pipelined), older logs hold just the owner_id
+        return content[0] if isinstance(content, tuple) else content
+
+    def get_request_content(self, owner_id, op: Operation):
+        if self.pipelined():
+            return owner_id, dict(self.seen_db_seqs), op.id
+        return owner_id, dict(self.seen_db_seqs)
+
+    def get_answers_key(self, op: Operation):
+        # The key of the ACK_GET_TOKENS answering the operation (see upon_registry.UPON_KEYS)
+        return op.id if self.pipelined() else None
+
+    def available_tokens(self) -> List[Token]:
+        # Our tokens that no PAY of ours is sending
+        if not self.tokens_in_flight:
+            return self.my_tokens
+        return [token for token in self.my_tokens if token.id not in self.tokens_in_flight]
+
+    def can_replay_action(self, action_type, action_msg):
+        # With pipelining, our operations may finish in another order than they were logged (finishes are popped in
+        # order), so a replayed PAY waits until its tokens are ours and no other PAY of ours sends them. It reserves them
+        if not self.pipelined() or action_type != ActionType.PAY_START:
+            return True
+        token_ids = [token_id for token_id, _, _ in self.get_pay_entries(action_msg.content)]
+        my_token_ids = {token.id for token in self.my_tokens}
+        if any(token_id not in my_token_ids or token_id in self.tokens_in_flight for token_id in token_ids):
+            return False
+        self.tokens_in_flight.update(token_ids)
+        return True
 
-        # Initialize my tokens from the whole dictionary
-        for token in list(self.tokens_db.values()):
-            if token.owner == self.id:
-                self.my_tokens.append(token)
-    
     def should_omit_msg(self):
         # Drop messages according to the omission rate
-        return self.is_faulty and (random.random() < self.omission_rate)
+        return self.is_faulty and (self.ctx.rng.random() < self.omission_rate)
     
-    def log_action(self, action_type, action_msg = None):
-        # Some actions we save for repeating in case of omissions or transformations
-        if action_type in [ActionType.PAY_START, ActionType.GET_TOKENS_START, ActionType.CLIENT_TRANSFORM_START, ActionType.SERVER_TRANSFORM_START]:
-            self.last_action_msg = action_msg
-            self.last_action_timestamp = simulation_state.step_counter
-        elif action_type in [ActionType.PAY_FINISH, ActionType.GET_TOKENS_FINISH, ActionType.CLIENT_TRANSFORM_FINISH, ActionType.SERVER_TRANSFORM_FINISH]:
-            self.last_action_msg = None
-            self.last_action_timestamp = None
+    def log_action(self, action_type, action_msg = None, op: Operation = None):
+        # The operation of a starting action is saved for repeating in case of omissions or transformations,
+        # until the action finishes. A finish is logged with the message of its operation, so it can be told which
+        # start it finishes when operations finish out of order
+        if action_type in FINISH_ACTIONS:
+            action_msg = op.msg
+
+        if action_type in START_ACTIONS:
+            op.action_type = action_type
+            op.msg = action_msg
+            op.timestamp = self.ctx.step_counter
+            op.retry_attempt = 0
+            op.timeout = self.backoff(0)
+            self.operations[op.id] = op
+        elif action_type in FINISH_ACTIONS:
+            self.operations.pop(op.id, None)
 
         # Pay actions linearization point is not at the end of the action
         if action_type == ActionType.PAY_START:
-            simulation_state.mark_pay_start(self.id, simulation_state.step_counter)
+            self.ctx.mark_pay_start(self.id, op.id, self.get_pay_key(action_msg.content), self.ctx.step_counter)
+        elif action_type == ActionType.PAY_FINISH:
+            self.ctx.mark_pay_finish(self.id, op.id, self.get_pay_key(action_msg.content))
 
-        if simulation_state.WRITE_TO_LOG:
-            simulation_state.action_log.append((self.id, simulation_state.step_counter, action_type, action_msg))
+        if self.ctx.WRITE_TO_LOG:
+            self.ctx.action_log.append((self.id, self.ctx.step_counter, action_type, action_msg))
 
-        elif simulation_state.READ_FROM_LOG:
+        elif self.ctx.READ_FROM_LOG:
             # If we are reading from log, then pop the finish action from it
             if action_type in [ActionType.PAY_LINEARIZATION, ActionType.PAY_FINISH, ActionType.GET_TOKENS_FINISH, ActionType.CLIENT_TRANSFORM_FINISH, ActionType.SERVER_TRANSFORM_FINISH]:
                 # Remove the corresponding finish in the action log
-                for i, log_entry in enumerate(simulation_state.action_log):
-                    if log_entry[0] == self.id and log_entry[2] == action_type:
-                        if action_type == ActionType.PAY_LINEARIZATION:
-                            print(f'$$$PAY_LINEAR$$$ :: Seller: [...{str(self.id)[-4:]}]')
-                        simulation_state.action_log.pop(i)
-                        break
-
-    def step(self, msg_in) -> Optional[Message]:
-        msg_out = None
-
-        # if received a message and it didn't omission - handle it according to the role
-        if msg_in is not None:
-            should_omit_incoming = self.should_omit_msg()
-            if should_omit_incoming:
-                print(f'>OMIT//INCOMING< :: {self.role} :: [...{str(self.id)[-4:]}]')
-                msg_out = None
-            else:
-                msg_out = self.handle_incoming(msg_in)
-
-                should_omit_outgoing = self.should_omit_msg()
-                if should_omit_outgoing:
-                    print(f'>OMIT//OUTGOING< :: {self.role} :: [...{str(self.id)[-4:]}]')
-                    msg_out = None
+                if self.ctx.replay.pop_first(self.id, action_type) is not None:
+                    if action_type == ActionType.PAY_LINEARIZATION:
+                        if self.ctx.tracer.info:
+                            self.ctx.tracer.emit('pay_linearization', agent=self.id)
+
+    def timeout_step(self):
+        # The first step from which an operation is done again if it didn't finish, None if there is no operation
+        if not self.operations:
+            return None
+        return min(op.timeout_step() for op in self.operations.values())
+
+    def backoff(self, attempt):
+        return BACKOFFS[self.ctx.RETRY_BACKOFF](self.ctx.ACTION_TIMEOUT, self.ctx.MAX_ACTION_TIMEOUT, attempt, self.ctx.rng)
+
+    def retry_msg(self, op: Operation) -> Message:
+        # The message of the operation, sent again. With RETRY_TARGETED only to the servers that didn't answer it yet
+        msg = op.msg
+        if not self.ctx.RETRY_TARGETED or op.upon is None or msg.receiver_id != Message.BROADCAST_SERVER:
+            return msg
+
+        missing = tuple(server_id for server_id in self.ctx.servers if server_id not in op.upon.senders)
+        if not missing:
+            # Everyone answered but there are still not enough answers (e.g. the servers changed), so ask them all again
+            return msg
+        return Message(msg.type, msg.sender_id, missing, msg.content)
+
+    def act(self) -> List[Message]:
+        # What we do when not handling a message. For simplicity, we ignore sending omission in self initiated actions
+
+        # Check if we have operations that didn't finish in a long time
+        due = [op for op in self.operations.values() if self.ctx.step_counter >= op.timeout_step()]
+        if due:
+            # Do them again, and wait longer for them according to the backoff
+            msgs_out = []
+            for op in due:
+                if self.ctx.tracer.info:
+                    self.ctx.tracer.emit('action_timeout', agent=self.id, msg=op.msg)
+                msgs_out.append(self.retry_msg(op))
+                op.timestamp = self.ctx.step_counter
+                op.retry_attempt += 1
+                op.timeout = self.backoff(op.retry_attempt)
+            return msgs_out
+
+        # We can maybe start an action (if we have room for one)
+        if not self.can_start_action():
+            return []
 
-        # For simplicity, we ignore sending omission when running a self initiated action
-        
-        # Check if we have an action that didn't finish in a long time
-        elif self.last_action_msg is not None and simulation_state.step_counter - self.last_action_timestamp > simulation_state.ACTION_TIMEOUT:
-            # Do the action again
-            print(f'!ACTION//TIMEOUT! :: [...{str(self.id)[-4:]}] :: ~REPEATING~ :: {self.last_action_msg}')
-            msg_out = self.last_action_msg
-            self.last_action_timestamp = simulation_state.step_counter
-
-        # If didn't receive a msg we can maybe do an action (if one is not in progress)
-        elif not self.during_action:
-            # If we run from the logs then we maybe pop an action from it
-            if simulation_state.READ_FROM_LOG:
-                # If the next action is ours and is a start then pop it
-                if len(simulation_state.action_log) != 0 and simulation_state.action_log[0][0] == self.id and \
-                    simulation_state.action_log[0][2] != [ActionType.PAY_LINEARIZATION, ActionType.GET_TOKENS_START, ActionType.CLIENT_TRANSFORM_START, ActionType.SERVER_TRANSFORM_START]:
-                    _, _, action_type, action_msg = simulation_state.action_log.pop(0)
-                    if action_type == ActionType.PAY_START or action_type == ActionType.GET_TOKENS_START:
-                        msg_out = self.client_create_action(action_msg)
-                    elif action_type == ActionType.CLIENT_TRANSFORM_START or action_type == ActionType.SERVER_TRANSFORM_START:
-                        msg_out = self.transform()
-            else:            
-                # Decide randomly if to transform
-                if self.should_transform():
+        msg_out = None
+        # If we run from the logs then we maybe pop an action from it
+        if self.ctx.READ_FROM_LOG:
+            # If the next action is ours then pop it. While our operations are in progress only a PAY or a GET may start
+            # (a finish of one of them is popped when it finishes, and a transform waits for all of them)
+            next_action = self.ctx.replay.peek()
+            if next_action is not None and next_action[0] == self.id and (not self.operations or next_action[2] in PIPELINED_ACTIONS) \
+                    and self.can_replay_action(next_action[2], next_action[3]):
+                _, _, action_type, action_msg = self.ctx.replay.pop_next()
+                if action_type == ActionType.PAY_START or action_type == ActionType.GET_TOKENS_START:
+                    msg_out = self.client_create_action(action_msg)
+                elif action_type == ActionType.CLIENT_TRANSFORM_START or action_type == ActionType.SERVER_TRANSFORM_START:
                     msg_out = self.transform()
+        else:
+            # Decide randomly if to transform (only with no other operation in progress)
+            if not self.operations and self.should_transform():
+                msg_out = self.transform()
 
-                # Decide randomly if to do an action (clients only)
-                elif self.role == AgentRole.CLIENT:
-                    msg_out = self.client_create_action()
+            # Decide randomly if to do an action (clients only)
+            elif self.role == AgentRole.CLIENT:
+                msg_out = self.client_create_action()
 
-        return msg_out
+        return [msg_out] if msg_out is not None else []
+
+    def draw_omissions(self, amount) -> Optional[List[bool]]:
+        # Omission decisions for a whole batch of messages, drawn at once. None if we never omit
+        if not self.is_faulty:
+            return None
+        return self.ctx.rng.choices((True, False), (self.omission_rate, 1 - self.omission_rate), k=amount)
+
+    def step_batch(self, msgs_in: List[Message], act=True) -> List[Message]:
+        # All the messages delivered to us in a step are handled in one call, and then (if act) we maybe do an action.
+        # Returns the messages to send.
+        tracer = self.ctx.tracer
+        msgs_out = []
+
+        # Two decisions per message: omit it incoming, and omit the answer outgoing
+        omissions = self.draw_omissions(2 * len(msgs_in)) if msgs_in else None
+        for i, msg_in in enumerate(msgs_in):
+            if tracer.debug:
+                tracer.emit('received', msg_type=msg_in.type, sender=msg_in.sender_id, sender_role=self.ctx.get_agent_role_by_id(msg_in.sender_id),
+                            receiver=self.id, receiver_role=self.role)
+
+            if omissions is not None and omissions[2 * i]:
+                if tracer.debug:
+                    tracer.emit('omit_incoming', agent=self.id, role=self.role)
+                continue
+
+            # The answer is a message, or a list of them
+            answer = self.handle_incoming(msg_in)
+            if omissions is not None and omissions[2 * i + 1]:
+                if tracer.debug:
+                    tracer.emit('omit_outgoing', agent=self.id, role=self.role)
+                continue
+
+            for msg_out in (answer if isinstance(answer, list) else (answer,)):
+                if msg_out is not None:
+                    if tracer.debug:
+                        tracer.emit('sent', msg_type=msg_out.type, sender=self.id, sender_role=self.role,
+                                    receiver=msg_out.receiver_id, receiver_role=self.ctx.get_agent_role_by_id(msg_out.receiver_id))
+                    msgs_out.append(msg_out)
+
+        for action_msg in (self.act() if act else []):
+            if tracer.debug:
+                tracer.emit('action_sent', msg_type=action_msg.type, sender=self.id, sender_role=self.role, receiver=action_msg.receiver_id)
+            msgs_out.append(action_msg)
+
+        return msgs_out
 
     def handle_incoming(self, msg_in):
-        # Check if we are waiting for this type of message:
-        for upon in self.upon_registry:
-            func_to_run, upon_filter, upon_amount, msgs = upon
-            if upon_filter(msg_in):
-                msgs.append(msg_in)
-                
-                # If enough messages where received run the function and remove the upon
-                if len(msgs) >= upon_amount():
-                    self.upon_registry.remove(upon)
-                    msg = func_to_run(self, msgs)
-                    return msg
+        # Check if we are waiting for this type of message.
+        # If enough messages where received the upon is removed and we run its function
+        upon = self.upon_registry.receive(msg_in)
+        if upon is not None:
+            return upon.func_to_run(self, upon.msgs)
 
         # Messages we didn't specifically wait for
         if self.role == AgentRole.CLIENT:
@@ -134,30 +339,34 @@ class Agent:
 
     def should_transform(self):
         # Check if can transform
-        if (self.role == AgentRole.CLIENT and simulation_state.can_add_server()) or \
-            (self.role == AgentRole.SERVER and simulation_state.can_remove_server()):
+        if (self.role == AgentRole.CLIENT and self.ctx.can_add_server()) or \
+            (self.role == AgentRole.SERVER and self.ctx.can_remove_server()):
             # Randomly decide
-            rand_choice = random.random()
+            rand_choice = self.ctx.rng.random()
             if self.role == AgentRole.CLIENT:
-                return rand_choice < simulation_state.CLIENT_TRANSFORM_RATE and not simulation_state.client_transforming_flag
-            elif self.role == AgentRole.SERVER and (self.is_faulty or simulation_state.faulty_counter < (len(simulation_state.servers) - 1) / 2):
-                return rand_choice < simulation_state.SERVER_TRANSFORM_RATE and not simulation_state.server_transforming_flag
+                return rand_choice < self.ctx.CLIENT_TRANSFORM_RATE and not self.ctx.client_transforming_flag
+            elif self.role == AgentRole.SERVER and (self.is_faulty or self.ctx.faulty_counter < (len(self.ctx.servers) - 1) / 2):
+                return rand_choice < self.ctx.SERVER_TRANSFORM_RATE and not self.ctx.server_transforming_flag
         return False
 
     def transform(self) -> Message:
         # Run the specific logic of the role
         if self.role == AgentRole.CLIENT:
-            simulation_state.client_transforming_flag = 1
+            self.ctx.client_transforming_flag = 1
             out_msg = self.transform_to_server()
         elif self.role == AgentRole.SERVER:
-            simulation_state.server_transforming_flag = 1
+            self.ctx.server_transforming_flag = 1
             out_msg = self.transform_to_client()
 
         return out_msg or None
 
-    # Register a function to run when receiving an amount of messages of the same type
-    def register_upon(self, func_to_run, upon_filter, upon_amount):
-        self.upon_registry.append((func_to_run, upon_filter, upon_amount, []))    
+    # Register a function to run when receiving an amount of messages of the same type (and key, see upon_registry.UPON_KEYS),
+    # waiting for the answers of the operation
+    def register_upon(self, func_to_run, msg_type, upon_amount, key=None, op: Operation = None):
+        upon = self.upon_registry.register(func_to_run, msg_type, upon_amount, key)
+        if op is not None:
+            op.upon = upon
+        return upon
 
     def give_token(self, token: Token):
         self.my_tokens.append(token)
@@ -172,75 +381,59 @@ class Agent:
     def client_handle_incoming(self, msg_in):
         # Client can only handle incoming TURNED_TO_CLIENT messages, which trigger a recount of upons
         if msg_in.type == MessageType.TURNED_TO_CLIENT:
-            for upon in self.upon_registry:
-                func_to_run, _, upon_amount, msgs = upon
-                if len(msgs) >= upon_amount():
-                    self.upon_registry.remove(upon)
-                    return func_to_run(self, msgs)
+            upon = self.upon_registry.pop_ready()
+            if upon is not None:
+                return upon.func_to_run(self, upon.msgs)
         
-        # if a client turned server, we send him our in-process action
+        # if a client turned server, we send him our in-process actions
         if msg_in.type == MessageType.TURNED_TO_SERVER and self.during_action:
-            copy_last_action = copy.deepcopy(self.last_action_msg) 
-            copy_last_action.receiver_id = msg_in.sender_id
-            return copy_last_action
+            msgs_out = [Message(op.msg.type, op.msg.sender_id, msg_in.sender_id, op.msg.content) for op in self.operations.values()]
+            return msgs_out[0] if len(msgs_out) == 1 else msgs_out
 
         return None
         
     def transform_to_server(self):
-        print(f'!TRANSFORMATION! :: [...{str(self.id)[-4:]}] :: ~INITIATED~ :: CLIENT --> SERVER.')
+        if self.ctx.tracer.info:
+            self.ctx.tracer.emit('transform_initiated', agent=self.id, from_role=AgentRole.CLIENT, to_role=AgentRole.SERVER)
         # Agent sends a getToken request to update the db, and upon finishing the agent transforms
-        to_send = Message(MessageType.GET_TOKENS, self.id, Message.BROADCAST_SERVER, ())
-        self.log_action(ActionType.CLIENT_TRANSFORM_START, to_send)
+        op = self.new_operation()
+        to_send = Message(MessageType.GET_TOKENS, self.id, Message.BROADCAST_SERVER, self.get_request_content(0, op))
+        self.log_action(ActionType.CLIENT_TRANSFORM_START, to_send, op)
 
         # When receiving answers
         def handle_transform_get(agent : Agent, msgs : List[Message]):
-            # Reset the inner db
-            agent.tokens_db = {}
-            for msg in msgs:
-                tokens_list = msg.content
-                for token in tokens_list:
-                    # If we already have this token, update it if the version is higher
-                    if token.id in agent.tokens_db:
-                        if token.version > agent.tokens_db[token.id].version:
-                            agent.tokens_db[token.id] = token
-                    else:
-                        agent.tokens_db[token.id] = token
-
-            # Unlock action-doing
-            agent.during_action = False
+            # Bring the inner db up to date
+            agent.merge_get_tokens_answers(msgs)
 
             # Turn into a server
-            del simulation_state.clients[self.id]
-            simulation_state.servers[self.id] = self
+            del self.ctx.clients[self.id]
+            self.ctx.servers[self.id] = self
             self.role = AgentRole.SERVER
-            simulation_state.client_transforming_flag = 0
+            self.ctx.client_transforming_flag = 0
 
-            print(f'!TRANSFORMATION! :: [...{str(self.id)[-4:]}] :: ~DONE~ :: CLIENT --> SERVER.')
-            self.log_action(ActionType.CLIENT_TRANSFORM_FINISH)
+            if self.ctx.tracer.info:
+                self.ctx.tracer.emit('transform_done', agent=self.id, from_role=AgentRole.CLIENT, to_role=AgentRole.SERVER)
+            self.log_action(ActionType.CLIENT_TRANSFORM_FINISH, op=op)
 
-            if simulation_state.ALLOW_FAULTY and simulation_state.faulty_counter < len(simulation_state.servers)/2:
-                self.set_omission_rate(simulation_state.FAULTY_OMISSION_RATE)
-                simulation_state.faulty_counter += 1
+            if self.ctx.ALLOW_FAULTY and self.ctx.faulty_counter < len(self.ctx.servers)/2:
+                self.set_omission_rate(self.ctx.SERVER_OMISSION_RATE)
+                self.ctx.faulty_counter += 1
 
             # Tell clients to send their actions
             return Message(MessageType.TURNED_TO_SERVER, agent.id, Message.BROADCAST_CLIENT, ())
 
         # Register the function to handle the incoming messages
-        self.register_upon(handle_transform_get, 
-                        lambda msg: msg.type == MessageType.ACK_GET_TOKENS, simulation_state.get_n_minus_t_amount)
-        
-        # Lock action-doing
-        self.during_action = True
+        self.register_upon(handle_transform_get, MessageType.ACK_GET_TOKENS, self.ctx.get_n_minus_t_amount, self.get_answers_key(op), op)
 
         return to_send
 
     def client_create_action(self, premade_msg = None) -> Optional[Message]:
         ACTIONS = [
             [MessageType.PAY, MessageType.GET_TOKENS, None], 
-            [simulation_state.CLIENT_PAY_RATE, simulation_state.CLIENT_GET_RATE, simulation_state.CLIENT_NONE_RATE]
+            [self.ctx.CLIENT_PAY_RATE, self.ctx.CLIENT_GET_RATE, self.ctx.CLIENT_NONE_RATE]
         ]
     
-        action_type = random.choices(ACTIONS[0], ACTIONS[1], k=1)[0] if not premade_msg else premade_msg.type
+        action_type = self.ctx.rng.choices(ACTIONS[0], ACTIONS[1], k=1)[0] if not premade_msg else premade_msg.type
         
         if action_type == MessageType.PAY and (len(self.my_tokens) > 0):
             return self.run_get_then_pay_request(premade_msg)
@@ -250,93 +443,136 @@ class Agent:
             return None
 
     def run_get_then_pay_request(self, premade_msg = None):
+        if self.pay_can_skip_get():
+            return self.run_pay_request(premade_msg)
         return self.run_get_request(True, premade_msg)
 
+    def pay_can_skip_get(self):
+        # The versions we pay with come from our own tokens, which the seller handed us with their new version,
+        # so the GET round only brings our DB up to date. It is skipped if we did that recently enough
+        return self.db_is_fresh(self.ctx.PAY_SKIP_GET_MAX_AGE)
+
     def run_pay_request(self, premade_msg = None) -> Message:
-        # Choose a random token to send and a random owner to receive
-        token_to_sell = random.choice(self.my_tokens) if not premade_msg else [token for token in self.my_tokens if token.id == premade_msg.content[0]][0]
-        buyer_id = simulation_state.get_random_agent().id if not premade_msg else premade_msg.content[1]
+        # A replayed PAY is sent the way it was recorded
+        batch = isinstance(premade_msg.content, list) if premade_msg else self.ctx.PAY_BATCH_SIZE > 1
+        if batch:
+            return self.run_batch_pay_request(premade_msg)
+
+        # Choose a random token to send (that no other PAY of ours is sending) and a random owner to receive
+        available_tokens = self.available_tokens()
+        if not available_tokens and not premade_msg:
+            return None
+        token_to_sell = self.ctx.rng.choice(available_tokens) if not premade_msg else [token for token in self.my_tokens if token.id == premade_msg.content[0]][0]
+        buyer_id = self.ctx.get_random_agent().id if not premade_msg else premade_msg.content[1]
         to_send = Message(MessageType.PAY, self.id, Message.BROADCAST_SERVER, (token_to_sell.id, buyer_id, token_to_sell.version + 1))
 
-        self.log_action(ActionType.PAY_START, to_send)
-        print(f'~~PAY//STARTED~~ :: [...{str(self.id)[-4:]}]')
-        print(f'$$$TOKEN-SUGG$$$ :: Token ID: [...{str(token_to_sell.id)[-4:]}] / Version: {token_to_sell.version} :: [...{str(self.id)[-4:]}] --> [...{str(buyer_id)[-4:]}]')
+        op = self.new_operation()
+        self.log_action(ActionType.PAY_START, to_send, op)
+        self.tokens_in_flight.add(token_to_sell.id)
+        if self.ctx.tracer.info:
+            self.ctx.tracer.emit('pay_started', agent=self.id, token=token_to_sell.id, version=token_to_sell.version, buyer=buyer_id)
 
         # When receiving answers, remove the sold token from the list
         def handle_ack_pay(agent : Agent, msgs : List[Message]):
-            self.log_action(ActionType.PAY_FINISH)
-            print(f'~~~PAY//ENDED~~~ :: [...{str(agent.id)[-4:]}]')
-            print(f'$$$TOKEN-SOLD$$$ :: Token ID: [...{str(token_to_sell.id)[-4:]}] / Version: {token_to_sell.version} :: [...{str(self.id)[-4:]}] --> [...{str(buyer_id)[-4:]}]')
+            self.log_action(ActionType.PAY_FINISH, op=op)
+            if self.ctx.tracer.info:
+                self.ctx.tracer.emit('pay_ended', agent=agent.id, token=token_to_sell.id, version=token_to_sell.version, buyer=buyer_id)
 
-            # Update the version of the token then do the transfer
-            token_to_sell.version += 1 
+            # Transfer the token with its new version. Tokens are shared, so the buyer gets a new one.
+            # A quorum acknowledged it, so our cache knows it too
             self.my_tokens.remove(token_to_sell)
-            simulation_state.agents[buyer_id].my_tokens.append(token_to_sell)
+            self.tokens_in_flight.discard(token_to_sell.id)
+            sold_token = Token(token_to_sell.id, token_to_sell.version + 1, buyer_id)
+            self.ctx.agents[buyer_id].my_tokens.append(sold_token)
+            self.learn_token(sold_token)
 
-            # Unlock action-doing
-            agent.during_action = False
+        # Register the handling, waiting for ACK_PAY responses with the right token_id and version
+        self.register_upon(handle_ack_pay, MessageType.ACK_PAY, self.ctx.get_n_minus_t_amount, self.get_pay_key(to_send.content), op)
 
-        # Wait for ACK_PAY responses with the right token_id and version
-        def handle_ack_filter(msg : Message) -> bool:
-            if msg.type != MessageType.ACK_PAY:
-                return False
-            
-            token_id, token_version = msg.content
-            return token_id == token_to_sell.id and token_version == (token_to_sell.version + 1)
+        return to_send
 
-        # Register the handling
-        self.register_upon(handle_ack_pay, handle_ack_filter, simulation_state.get_n_minus_t_amount)
-        
-        # Lock action-doing
-        self.during_action = True
+    def run_batch_pay_request(self, premade_msg = None) -> Message:
+        # Pay up to PAY_BATCH_SIZE random tokens, each to a random buyer, in one quorum round
+        if premade_msg:
+            my_tokens = {token.id: token for token in self.my_tokens}
+            tokens_to_sell = [my_tokens[token_id] for token_id, _, _ in premade_msg.content]
+            buyer_ids = [buyer_id for _, buyer_id, _ in premade_msg.content]
+        else:
+            available_tokens = self.available_tokens()
+            if not available_tokens:
+                return None
+            tokens_to_sell = self.ctx.rng.sample(available_tokens, min(self.ctx.PAY_BATCH_SIZE, len(available_tokens)))
+            buyer_ids = [self.ctx.get_random_agent().id for _ in tokens_to_sell]
+        entries = [(token.id, buyer_id, token.version + 1) for token, buyer_id in zip(tokens_to_sell, buyer_ids)]
+        to_send = Message(MessageType.PAY, self.id, Message.BROADCAST_SERVER, entries)
+
+        op = self.new_operation()
+        self.log_action(ActionType.PAY_START, to_send, op)
+        self.tokens_in_flight.update(token.id for token in tokens_to_sell)
+        if self.ctx.tracer.info:
+            for token, buyer_id in zip(tokens_to_sell, buyer_ids):
+                self.ctx.tracer.emit('pay_started', agent=self.id, token=token.id, version=token.version, buyer=buyer_id)
+
+        # When receiving answers, hand every token to its buyer
+        def handle_ack_pay(agent : Agent, msgs : List[Message]):
+            self.log_action(ActionType.PAY_FINISH, op=op)
+            for token, buyer_id in zip(tokens_to_sell, buyer_ids):
+                if self.ctx.tracer.info:
+                    self.ctx.tracer.emit('pay_ended', agent=agent.id, token=token.id, version=token.version, buyer=buyer_id)
+                self.my_tokens.remove(token)
+                self.tokens_in_flight.discard(token.id)
+                sold_token = Token(token.id, token.version + 1, buyer_id)
+                self.ctx.agents[buyer_id].my_tokens.append(sold_token)
+                self.learn_token(sold_token)
+
+        # A batch is acknowledged by one ACK_PAY listing every (token_id, version) of it
+        self.register_upon(handle_ack_pay, MessageType.ACK_PAY, self.ctx.get_n_minus_t_amount, self.get_pay_key(entries), op)
 
         return to_send
 
+    def trace_get_answer(self, owner_id):
+        # The answer of a GET about an owner is the tokens of the owner in our (updated) DB, from its owner index
+        # (the GET round of a PAY, about owner 0, has no answer of its own)
+        if self.ctx.tracer.info:
+            if owner_id == 0:
+                self.ctx.tracer.emit('get_ended', agent=self.id)
+            else:
+                tokens = [(token.id, token.owner) for token in self.tokens_db.tokens_of(owner_id)]
+                self.ctx.tracer.emit('get_ended', agent=self.id, owner=owner_id, tokens=tokens)
+
     def run_get_request(self, part_of_pay_request=False, premade_msg = None) -> Message:
         # send <getToken, random_owner> to all
         if part_of_pay_request:
             owner_id = 0
         else:
-            owner_id = simulation_state.get_random_agent().id if not premade_msg else premade_msg.content
+            owner_id = self.ctx.get_random_agent().id if not premade_msg else self.get_request_owner(premade_msg.content)
+
+        # Servers answer only with what changed since the last answer we merged from them
+        op = self.new_operation()
+        to_send = Message(MessageType.GET_TOKENS, self.id, Message.BROADCAST_SERVER, self.get_request_content(owner_id, op))
+        self.log_action(ActionType.GET_TOKENS_START, to_send, op)
 
-        to_send = Message(MessageType.GET_TOKENS, self.id, Message.BROADCAST_SERVER, (owner_id))
-        self.log_action(ActionType.GET_TOKENS_START, to_send)
+        # A GET about an owner is answered from our DB if it is fresh enough (it has all the tokens of the owner)
+        if not part_of_pay_request and self.db_is_fresh(self.ctx.CLIENT_CACHE_MAX_AGE):
+            self.log_action(ActionType.GET_TOKENS_FINISH, op=op)
+            self.trace_get_answer(owner_id)
+            return None
 
         # When receiving answers
         def handle_ack_tokens(agent : Agent, msgs : List[Message]):
-            print(f'~~~GET//ENDED~~~ :: [...{str(agent.id)[-4:]}]')
-            self.log_action(ActionType.GET_TOKENS_FINISH)
-
-            # Reset the inner db
-            agent.tokens_db = {}
-            for msg in msgs:
-                tokens_list = msg.content
-                for token in tokens_list:
-                    # If we already have this token, update it if the version is higher
-                    if token.id in agent.tokens_db:
-                        if token.version > agent.tokens_db[token.id].version:
-                            agent.tokens_db[token.id] = token
-                    else:
-                        agent.tokens_db[token.id] = token
-
-            # Filter tokens by owner_id
-            owner_tokens = [(token_id, token) for token_id, token in agent.tokens_db.items() if token.owner == owner_id]
-            # Now the db is updated and owner_tokens holds all tokens belonging to the requested owner
+            self.log_action(ActionType.GET_TOKENS_FINISH, op=op)
+
+            # Bring the inner db up to date
+            agent.merge_get_tokens_answers(msgs)
+            agent.trace_get_answer(owner_id)
 
             if part_of_pay_request:
                 return self.run_pay_request(premade_msg)
 
-            # Unlock action-doing
-            agent.during_action = False
-
             return None
 
         # Register the function to handle the incoming messages
-        self.register_upon(handle_ack_tokens, 
-                        lambda msg: msg.type == MessageType.ACK_GET_TOKENS, simulation_state.get_n_minus_t_amount)
-        
-        # Lock action-doing
-        self.during_action = True
+        self.register_upon(handle_ack_tokens, MessageType.ACK_GET_TOKENS, self.ctx.get_n_minus_t_amount, self.get_answers_key(op), op)
 
         return to_send
 
@@ -353,6 +589,9 @@ class Agent:
             return self.server_handle_db_update(msg_in)
 
     def server_handle_pay(self, msg_in: Message):
+        if isinstance(msg_in.content, list):
+            return self.server_handle_batch_pay(msg_in)
+
         # Message looks like this: <pay, token_id, new_owner, new_version>
         token_id, new_owner, new_version = msg_in.content
         token = self.tokens_db[token_id]
@@ -360,70 +599,86 @@ class Agent:
         # Check that this version is newer - won't happen only if this is an old message
         if token is not None and token.version <= new_version:
             # Transfer token to buyer
-            token.owner = new_owner
-            token.version = new_version
+            token = Token(token_id, new_version, new_owner)
+            self.update_token(token)
 
             # Check the linearization of the pay
-            simulation_state.mark_pay_answer(msg_in.sender_id, simulation_state.step_counter)
+            self.ctx.mark_pay_answer(msg_in.sender_id, self.get_pay_key(msg_in.content), self.ctx.step_counter)
 
             return Message(MessageType.ACK_PAY, self.id, msg_in.sender_id, (token_id, token.version))
 
+    def server_handle_batch_pay(self, msg_in: Message):
+        # Message looks like this: <pay, [(token_id, new_owner, new_version), ...]>
+        # The batch is applied atomically: if any of its entries is of an old message, none of them is
+        entries = msg_in.content
+        for token_id, _, new_version in entries:
+            token = self.tokens_db.get(token_id)
+            if token is None or token.version > new_version:
+                return None
+
+        for token_id, new_owner, new_version in entries:
+            self.update_token(Token(token_id, new_version, new_owner))
+
+        # Check the linearization of the pay
+        self.ctx.mark_pay_answer(msg_in.sender_id, self.get_pay_key(entries), self.ctx.step_counter)
+
+        return Message(MessageType.ACK_PAY, self.id, msg_in.sender_id, [(token_id, new_version) for token_id, _, new_version in entries])
+
     def server_handle_get_tokens(self, msg_in: Message):
-        # Send all of the tokens as a list
-        return Message(MessageType.ACK_GET_TOKENS, self.id, msg_in.sender_id, (list(self.tokens_db.values())))
+        # Send the tokens that changed since the sequence the client last merged from us, and the current sequence.
+        # A client asking about a specific owner also gets the tokens of that owner (from the owner index of the DB).
+        # Tokens that left the owner are covered by the changes, and the client already holds the rest of the DB.
+        # A pipelined request ends with the id of its operation, which the answer ends with as well
+        owner_id, seen_db_seqs = msg_in.content[:2]
+        tokens_list = self.tokens_changed_since(seen_db_seqs.get(self.id, 0))
+        if owner_id != 0:
+            changed_ids = set(token.id for token in tokens_list)
+            tokens_list += [token for token in self.tokens_db.tokens_of(owner_id) if token.id not in changed_ids]
+
+        return Message(MessageType.ACK_GET_TOKENS, self.id, msg_in.sender_id, (tokens_list, self.db_seq) + msg_in.content[2:])
 
     def server_handle_db_update(self, msg_in: Message):
         # Update local DB based on version then ACK back.
-        tokens_list = msg_in.content
-        for token in tokens_list:
-            # If we already have this token, update it if the version is higher
-            if token.id in self.tokens_db:
-                if token.version > self.tokens_db[token.id].version:
-                    self.tokens_db[token.id] = token
-            else:
-                self.tokens_db[token.id] = token
+        self.merge_tokens(msg_in.content)
 
         return Message(MessageType.ACK_DB_UPDATE, self.id, msg_in.sender_id, ())
 
     def transform_to_client(self):
-        print(f'!TRANSFORMATION! :: [...{str(self.id)[-4:]}] :: ~INITIATED~ :: SERVER --> CLIENT.')
-        to_send = self.run_db_update_request()
-        self.log_action(ActionType.SERVER_TRANSFORM_START, to_send)
+        if self.ctx.tracer.info:
+            self.ctx.tracer.emit('transform_initiated', agent=self.id, from_role=AgentRole.SERVER, to_role=AgentRole.CLIENT)
+        op = self.new_operation()
+        to_send = self.run_db_update_request(op)
+        self.log_action(ActionType.SERVER_TRANSFORM_START, to_send, op)
 
         return to_send
 
-    def run_db_update_request(self) -> Message:
+    def run_db_update_request(self, op: Operation) -> Message:
         # Send my db to all others and ask them to update their own based on my db
         # send <dbUpdate, my_db> to all
+        # All the DBs share the same base, so only the tokens changed on top of it can update another DB
 
-        to_send = Message(MessageType.DB_UPDATE, self.id, Message.BROADCAST_SERVER, (list(self.tokens_db.values())))
+        to_send = Message(MessageType.DB_UPDATE, self.id, Message.BROADCAST_SERVER, self.tokens_db.changed_tokens())
 
         # When receiving answers
         def handle_ack_db_update(agent: Agent, msgs: List[Message]):
             # Actual transformation to client logic
             # Transform only if there are less faulty servers than required or self is a faulty server
-            del simulation_state.servers[agent.id]
-            simulation_state.clients[agent.id] = agent
+            del self.ctx.servers[agent.id]
+            self.ctx.clients[agent.id] = agent
             agent.role = AgentRole.CLIENT
-            simulation_state.server_transforming_flag = 0
+            self.ctx.server_transforming_flag = 0
 
             if self.is_faulty:
-                agent.set_omission_rate(simulation_state.CLIENT_OMISSION_RATE)
+                agent.set_omission_rate(self.ctx.CLIENT_OMISSION_RATE)
 
-            print(f'!TRANSFORMATION! :: [...{str(agent.id)[-4:]}] :: ~DONE~ :: SERVER --> CLIENT.')
-            self.log_action(ActionType.SERVER_TRANSFORM_FINISH)
-
-            # Unlock action-doing
-            agent.during_action = False
+            if self.ctx.tracer.info:
+                self.ctx.tracer.emit('transform_done', agent=agent.id, from_role=AgentRole.SERVER, to_role=AgentRole.CLIENT)
+            self.log_action(ActionType.SERVER_TRANSFORM_FINISH, op=op)
 
             # Send a message to all clients to announce change
             return Message(MessageType.TURNED_TO_CLIENT, agent.id, Message.BROADCAST_CLIENT, ())
 
         # Register the function to handle the incoming messages
-        self.register_upon(handle_ack_db_update,
-                           lambda msg: msg.type == MessageType.ACK_DB_UPDATE, simulation_state.get_t_plus_one)
-
-        # Lock action-doing
-        self.during_action = True
+        self.register_upon(handle_ack_db_update, MessageType.ACK_DB_UPDATE, self.ctx.get_t_plus_one, op=op)
 
         return to_send
\ No newline at end of file
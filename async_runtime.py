@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import random
+from typing import Callable
+
+from agent import Agent
+from event_engine import exponential
+from interfaces import ActionType, Message
+import simulation_state
+from simulation_state import SimulationContext
+from simulator import Simulator
+from tracing import TraceLevel
+
+
+class AsyncTransport:
+    # Delivers messages into the inboxes of the agents, after a random delay, and drops some of them.
+    # Has the add(receiver_id, msg) of the schedulers, so broadcasts are fanned out by Simulator.add_msg_to_queue.
+
+    def __init__(self, rng: random.Random, drop_rate=0.0, delay: Callable[[random.Random], float] = None):
+        self.rng = rng
+        self.drop_rate = drop_rate
+        self.delay = delay
+        self.inboxes = {}
+
+        # Messages on their way to an inbox, and totals
+        self.in_flight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def __len__(self):
+        return self.in_flight
+
+    def add(self, receiver_id, msg: Message):
+        self.sent += 1
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            return
+
+        self.in_flight += 1
+        delay = self.delay(self.rng) if self.delay is not None else 0
+        asyncio.get_running_loop().call_later(delay, self.deliver, receiver_id, msg)
+
+    def deliver(self, receiver_id, msg: Message):
+        self.in_flight -= 1
+        self.delivered += 1
+        self.inboxes[receiver_id].put_nowait(msg)
+
+
+class AsyncRuntime(Simulator):
+    # Runs every agent as an asyncio task with its own inbox, under real concurrency.
+    # The agents wake up on every message (handling everything waiting in their inbox at once), at their timeout, and
+    # every tick seconds while idle. ctx.step_counter counts the ticks since the start, so ACTION_TIMEOUT is in ticks.
+
+    def __init__(self, ctx: SimulationContext = None, tick=0.001, drop_rate=0.0, delay: Callable[[random.Random], float] = None):
+        super().__init__(ctx)
+        self.tick = tick
+        self.msgs_queue = AsyncTransport(self.rng, drop_rate, delay)
+        self.running = False
+        self.start_time = 0
+
+    def now_ticks(self):
+        return int((asyncio.get_running_loop().time() - self.start_time) / self.tick)
+
+    def pending(self):
+        # Messages on their way, or operations waiting on them or on their retry timers
+        return len(self.msgs_queue) > 0 or any(not inbox.empty() for inbox in self.msgs_queue.inboxes.values()) \
+            or any(agent.during_action for agent in self.local_agents())
+
+    def wait_time(self, agent):
+        # Idle agents wake up every tick to maybe start an action, the others only on a message or at their timeout
+        timeout_step = agent.timeout_step()
+        if agent.can_start_action() or timeout_step is None:
+            return self.tick
+        return max(timeout_step - self.now_ticks(), 1) * self.tick
+
+    async def run_agent(self, agent):
+        inbox = self.msgs_queue.inboxes[agent.id]
+        while self.running:
+            try:
+                msgs = [await asyncio.wait_for(inbox.get(), self.wait_time(agent))]
+            except asyncio.TimeoutError:
+                msgs = []
+            while not inbox.empty():
+                msgs.append(inbox.get_nowait())
+
+            self.ctx.step_counter = self.now_ticks()
+            for msg_out in agent.step_batch(msgs):
+                self.add_msg_to_queue(msg_out)
+
+    def local_agents(self):
+        # The agents run by this runtime
+        return list(self.ctx.get_all_agents())
+
+    async def run(self, duration, drain_timeout=5.0):
+        # Load for duration seconds, then close and let the operations in flight finish (for up to drain_timeout)
+        loop = asyncio.get_running_loop()
+        self.start_time = loop.time()
+        agents = self.local_agents()
+        self.msgs_queue.inboxes = {agent.id: asyncio.Queue() for agent in agents}
+        self.running = True
+        tasks = [asyncio.create_task(self.run_agent(agent)) for agent in agents]
+
+        await asyncio.sleep(duration)
+        load_time = loop.time() - self.start_time
+        self.close()
+
+        deadline = loop.time() + drain_timeout
+        while self.pending() and loop.time() < deadline:
+            await asyncio.sleep(self.tick)
+        self.running = False
+        await asyncio.gather(*tasks)
+
+        return self.report(load_time, loop.time() - self.start_time)
+
+    def report(self, load_time, total_time):
+        pays, gets = count_finished(self.ctx.action_log)
+        return {
+            'load_time': load_time,
+            'total_time': total_time,
+            'pays': pays,
+            'gets': gets,
+            'ops_per_sec': (pays + gets) / total_time,
+            'pays_per_sec': pays / total_time,
+            'msgs_sent': self.msgs_queue.sent,
+            'msgs_dropped': self.msgs_queue.dropped,
+            'msgs_per_sec': self.msgs_queue.delivered / total_time,
+            'unfinished_clients': sum(1 for client in self.ctx.get_all_clients() if client.during_action),
+        }
+
+
+def count_finished(action_log):
+    # Finished PAYs, and finished GETs the clients asked for. The GET round of a PAY (about owner 0) is part of the
+    # PAY, so it isn't counted as an operation of its own. A finish is logged with the GET it finishes
+    pays = gets = 0
+    for _, _, action_type, action_msg in action_log:
+        if action_type == ActionType.PAY_FINISH:
+            pays += 1
+        elif action_type == ActionType.GET_TOKENS_FINISH and action_msg is not None and Agent.get_request_owner(action_msg.content) != 0:
+            gets += 1
+    return pays, gets
+
+
+def print_report(report):
+    print('\n---------- ASYNC RUNTIME REPORT ----------')
+    print(f"Time: {report['total_time']:.2f}s ({report['load_time']:.2f}s of load)")
+    print(f"PAYs: {report['pays']}, GETs: {report['gets']}")
+    print(f"Throughput: {report['ops_per_sec']:.1f} ops/sec ({report['pays_per_sec']:.1f} PAYs/sec)")
+    print(f"Messages: {report['msgs_sent']} sent, {report['msgs_dropped']} dropped by the transport, {report['msgs_per_sec']:.1f} delivered/sec")
+    print(f"Clients with an unfinished action: {report['unfinished_clients']}")
+    print('---------- ---------- ----------\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the protocol with every agent running as an asyncio task.')
+    parser.add_argument('--duration', type=float, default=2.0, help='Seconds of load before closing')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--servers', type=int, default=7)
+    parser.add_argument('--tick', type=float, default=0.001, help='Seconds per tick (ACTION_TIMEOUT is in ticks)')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Rate of messages dropped by the transport')
+    parser.add_argument('--mean-delay', type=float, default=0.0005, help='Mean transport delay in seconds (exponential)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    # Seeded ids, so the cluster isn't limited by the size of ids.txt
+    ctx = SimulationContext(args.seed, TRACE_LEVEL=TraceLevel.OFF, ID_MODE='seeded',
+                            NUM_START_CLIENTS=args.clients, NUM_START_SERVERS=args.servers,
+                            MAX_SERVERS=max(args.servers, simulation_state.MAX_SERVERS))
+    runtime = AsyncRuntime(ctx, args.tick, args.drop_rate, exponential(args.mean_delay) if args.mean_delay > 0 else None)
+    print_report(asyncio.run(runtime.run(args.duration)))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+
+from async_runtime import AsyncRuntime, AsyncTransport
+from event_engine import pay_latencies
+from interfaces import Message
+import simulation_state
+from simulation_state import SimulationContext
+from simulator import Simulator
+from tracing import TraceLevel
+import wire_format
+
+# Every message is a frame: its length (4 bytes, big endian) then the message in the wire format
+FRAME_HEADER = struct.Struct('!I')
+
+
+def encode_message(msg: Message) -> bytes:
+    payload = wire_format.encode(msg)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decode_message(payload) -> Message:
+    return wire_format.decode(payload)
+
+async def read_frames(reader: asyncio.StreamReader):
+    # The payloads of the frames, until the connection is closed
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            payload = await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        yield payload
+
+async def open_connection(address):
+    # A unix socket path, or a (host, port) on localhost
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+def make_context(seed=0, clients=50, servers=7, pay_rate=0.3, batch_size=1, skip_get_age=None, pipeline_depth=1) -> SimulationContext:
+    # Every process of the cluster builds the same agents and tokens from the seed, and runs only its own ones.
+    # The servers are fixed (no transforms) and never omit messages: failures are real ones of the processes
+    return SimulationContext(seed, TRACE_LEVEL=TraceLevel.OFF, ID_MODE='seeded',
+                             NUM_START_CLIENTS=clients, NUM_START_SERVERS=servers,
+                             MIN_SERVERS=min(servers, simulation_state.MIN_SERVERS), MAX_SERVERS=max(servers, simulation_state.MAX_SERVERS),
+                             ALLOW_FAULTY=False, CLIENT_TRANSFORM_RATE=0, SERVER_TRANSFORM_RATE=0,
+                             CLIENT_PAY_RATE=pay_rate, CLIENT_GET_RATE=0,
+                             PAY_BATCH_SIZE=batch_size, PAY_SKIP_GET_MAX_AGE=skip_get_age, PIPELINE_DEPTH=pipeline_depth)
+
+
+class ServerProcess:
+    # One server agent, answering the messages of every connection to it.
+    # Answers go back on the connection the receiver last sent from, since connections are shared by many clients
+
+    def __init__(self, configs, index):
+        self.ctx = make_context(**configs)
+        Simulator(self.ctx)
+        self.agent = list(self.ctx.get_all_servers())[index]
+        self.routes = {}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async for payload in read_frames(reader):
+            msg = decode_message(payload)
+            self.routes[msg.sender_id] = writer
+            for msg_out in self.agent.step_batch([msg], act=False):
+                route = self.routes.get(msg_out.receiver_id)
+                if route is not None:
+                    route.write(encode_message(msg_out))
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, address, ready):
+        if isinstance(address, str):
+            server = await asyncio.start_unix_server(self.handle_connection, address)
+        else:
+            server = await asyncio.start_server(self.handle_connection, *address)
+
+        # Tell the driver where we listen (the port is picked by the OS)
+        address = server.sockets[0].getsockname()
+        ready.send(address if isinstance(address, str) else tuple(address[:2]))
+        ready.close()
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(configs, index, address, ready):
+    # Entry point of a server process
+    asyncio.run(ServerProcess(configs, index).serve(address, ready))
+
+
+class Cluster:
+    # The server processes, listening on unix sockets in a temporary directory or on localhost TCP ports
+
+    def __init__(self, configs, transport='unix'):
+        self.configs = configs
+        self.transport = transport
+        self.processes = []
+        self.socket_dir = None
+
+    def start(self):
+        # Start every server and wait until it listens. Returns the addresses, in the order of ctx.servers
+        mp = multiprocessing.get_context('spawn')
+        if self.transport == 'unix':
+            self.socket_dir = tempfile.mkdtemp(prefix='cluster-')
+
+        readies = []
+        for i in range(self.configs['servers']):
+            address = os.path.join(self.socket_dir, f'server-{i}.sock') if self.transport == 'unix' else ('127.0.0.1', 0)
+            ready, ready_child = mp.Pipe(duplex=False)
+            process = mp.Process(target=run_server, args=(self.configs, i, address, ready_child), daemon=True)
+            process.start()
+            ready_child.close()
+            self.processes.append(process)
+            readies.append(ready)
+
+        return [ready.recv() for ready in readies]
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+class ConnectionPool:
+    # pool_size persistent connections to every server, shared by all the clients of the driver.
+    # Requests go out round robin over the connections of a server, and answers come back on any of them
+
+    def __init__(self, addresses, pool_size=2):
+        self.addresses = addresses
+        self.pool_size = pool_size
+        self.connections = {}
+        self.next_connection = {}
+        self.readers = []
+
+    async def open(self, on_frame):
+        for server_id, address in self.addresses.items():
+            writers = []
+            for _ in range(self.pool_size):
+                reader, writer = await open_connection(address)
+                writers.append(writer)
+                self.readers.append(asyncio.create_task(self.read(reader, on_frame)))
+            self.connections[server_id] = writers
+            self.next_connection[server_id] = 0
+
+    @staticmethod
+    async def read(reader, on_frame):
+        async for payload in read_frames(reader):
+            on_frame(payload)
+
+    def send(self, server_id, frame):
+        writers = self.connections[server_id]
+        i = self.next_connection[server_id]
+        self.next_connection[server_id] = (i + 1) % len(writers)
+        writers[i].write(frame)
+
+    async def close(self):
+        for writers in self.connections.values():
+            for writer in writers:
+                writer.close()
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.gather(*self.readers, return_exceptions=True)
+
+
+class SocketTransport(AsyncTransport):
+    # Messages to servers go out through the pool (a broadcast is encoded once for all of them),
+    # and their answers are put in the inboxes of the clients
+
+    def __init__(self, pool: ConnectionPool):
+        super().__init__(None)
+        self.pool = pool
+        self.last_msg = None
+        self.last_frame = None
+
+    def add(self, receiver_id, msg: Message):
+        self.sent += 1
+        if receiver_id in self.pool.connections:
+            if msg is not self.last_msg:
+                self.last_msg, self.last_frame = msg, encode_message(msg)
+            self.pool.send(receiver_id, self.last_frame)
+        elif receiver_id in self.inboxes:
+            self.inboxes[receiver_id].put_nowait(msg)
+
+    def on_frame(self, payload):
+        msg = decode_message(payload)
+        self.delivered += 1
+        self.inboxes[msg.receiver_id].put_nowait(msg)
+
+
+class ClusterDriver(AsyncRuntime):
+    # Runs the clients as asyncio tasks in this process, each doing its PAYs against the server processes.
+    # ctx.step_counter is the (fractional) number of ticks since the start, so PAY latencies are measured precisely
+
+    def __init__(self, ctx: SimulationContext, addresses, pool_size=2, tick=0.001):
+        super().__init__(ctx, tick)
+        # The addresses of the servers, in the order of ctx.servers
+        self.pool = ConnectionPool(dict(zip(self.ctx.servers, addresses)), pool_size)
+        self.msgs_queue = SocketTransport(self.pool)
+
+    def now_ticks(self):
+        return (asyncio.get_running_loop().time() - self.start_time) / self.tick
+
+    def local_agents(self):
+        return list(self.ctx.get_all_clients())
+
+    def pending(self):
+        # Answers in flight can't be counted, so wait for the clients to finish their actions
+        return any(client.during_action for client in self.ctx.get_all_clients())
+
+    async def run(self, duration, drain_timeout=5.0):
+        await self.pool.open(self.msgs_queue.on_frame)
+        try:
+            return await super().run(duration, drain_timeout)
+        finally:
+            await self.pool.close()
+
+    def report(self, load_time, total_time):
+        report = super().report(load_time, total_time)
+        latencies = sorted(latency * self.tick * 1000 for latency in pay_latencies(self.ctx.action_log))
+        if latencies:
+            report['pay_latency_ms'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1],
+            }
+        return report
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def run_cluster(configs, transport='unix', duration=2.0, pool_size=2, tick=0.001):
+    ctx = make_context(**configs)
+    cluster = Cluster(configs, transport)
+    addresses = cluster.start()
+    try:
+        driver = ClusterDriver(ctx, addresses, pool_size, tick)
+        return asyncio.run(driver.run(duration))
+    finally:
+        cluster.stop()
+
+
+def print_report(report):
+    print('\n---------- CLUSTER REPORT ----------')
+    print(f"Time: {report['total_time']:.2f}s ({report['load_time']:.2f}s of load)")
+    print(f"PAYs: {report['pays']}, GETs: {report['gets']}")
+    print(f"Throughput: {report['ops_per_sec']:.1f} ops/sec ({report['pays_per_sec']:.1f} PAYs/sec)")
+    print(f"Messages: {report['msgs_sent']} sent, {report['msgs_per_sec']:.1f} answers/sec")
+    if 'pay_latency_ms' in report:
+        latency = report['pay_latency_ms']
+        print(f"PAY latency (ms): mean {latency['mean']:.2f}, p50 {latency['p50']:.2f}, p99 {latency['p99']:.2f}, max {latency['max']:.2f}")
+    print(f"Clients with an unfinished action: {report['unfinished_clients']}")
+    print('---------- ---------- ----------\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run every server as a process on localhost sockets, and load them with concurrent PAYs.')
+    parser.add_argument('--duration', type=float, default=2.0, help='Seconds of load before closing')
+    parser.add_argument('--clients', type=int, default=50, help='Clients issuing PAYs concurrently')
+    parser.add_argument('--servers', type=int, default=7, help='Server processes')
+    parser.add_argument('--transport', choices=('unix', 'tcp'), default='unix')
+    parser.add_argument('--pool-size', type=int, default=2, help='Connections from the driver to every server')
+    parser.add_argument('--pay-rate', type=float, default=1.0, help='Chance of an idle client to start a PAY every tick')
+    parser.add_argument('--batch-size', type=int, default=1, help='Most tokens moved by one PAY')
+    parser.add_argument('--skip-get-age', type=float, default=None, help='Skip the GET before a PAY if the last one finished at most this many ticks ago')
+    parser.add_argument('--pipeline-depth', type=int, default=1, help='Operations a client has in flight at once')
+    parser.add_argument('--tick', type=float, default=0.001, help='Seconds per tick (ACTION_TIMEOUT is in ticks)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    configs = {'seed': args.seed, 'clients': args.clients, 'servers': args.servers, 'pay_rate': args.pay_rate,
+               'batch_size': args.batch_size, 'skip_get_age': args.skip_get_age,
+               'pipeline_depth': args.pipeline_depth}
+    print_report(run_cluster(configs, args.transport, args.duration, args.pool_size, args.tick))
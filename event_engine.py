@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import math
+import random
+from typing import Callable, Dict, List, Tuple
+
+from agent import Agent
+from interfaces import ActionType, AgentRole, Message
+from simulation_state import SimulationContext
+from simulator import Simulator
+
+
+# Latency distributions: functions of a random.Random returning a latency in virtual time units
+def constant(value) -> Callable[[random.Random], float]:
+    return lambda rng: value
+
+def uniform(low, high) -> Callable[[random.Random], float]:
+    return lambda rng: rng.uniform(low, high)
+
+def exponential(mean) -> Callable[[random.Random], float]:
+    return lambda rng: rng.expovariate(1 / mean)
+
+def lognormal(mu, sigma) -> Callable[[random.Random], float]:
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class LatencyModel:
+    # Latency of every message, drawn from the distribution of its link (sender_id, receiver_id) if one was given,
+    # else of the roles of its ends (sender_role, receiver_role), else from the default distribution
+
+    def __init__(self, ctx: SimulationContext, rng: random.Random, default=None,
+                 per_role: Dict[Tuple[AgentRole, AgentRole], Callable] = None, per_link: Dict[Tuple, Callable] = None):
+        self.ctx = ctx
+        self.rng = rng
+        self.default = default if default is not None else exponential(ctx.MEAN_LATENCY)
+        self.per_role = per_role or {}
+        self.per_link = per_link or {}
+
+    def latency(self, sender_id, receiver_id):
+        distribution = self.per_link.get((sender_id, receiver_id))
+        if distribution is None and self.per_role:
+            roles = (self.ctx.get_agent_role_by_id(sender_id), self.ctx.get_agent_role_by_id(receiver_id))
+            distribution = self.per_role.get(roles)
+        if distribution is None:
+            distribution = self.default
+        return distribution(self.rng)
+
+
+class EventQueue:
+    # Pending deliveries in a heap ordered by their virtual delivery time.
+    # Has the add(receiver_id, msg) of the schedulers, so the simulator queues messages into it the same way.
+
+    def __init__(self, latency: LatencyModel, clock: Callable[[], float]):
+        self.latency = latency
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, receiver_id, msg: Message):
+        deliver_at = self.clock() + self.latency.latency(msg.sender_id, receiver_id)
+        heapq.heappush(self.heap, (deliver_at, next(self.seq), receiver_id, msg))
+
+    def next_time(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_until(self, time) -> List[Tuple[str, Message]]:
+        to_deliver = []
+        while self.heap and self.heap[0][0] <= time:
+            _, _, receiver_id, msg = heapq.heappop(self.heap)
+            to_deliver.append((receiver_id, msg))
+        return to_deliver
+
+
+class TimeoutHeap:
+    # Action timeouts at virtual times, with the add/pop_due of the timer wheel
+
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, due_time, key):
+        heapq.heappush(self.heap, (due_time, key))
+
+    def next_time(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, time):
+        due = set()
+        while self.heap and self.heap[0][0] <= time:
+            due.add(heapq.heappop(self.heap)[1])
+        return due
+
+
+class EventSimulator(Simulator):
+    # Event driven engine running the same agents as the lockstep Simulator.
+    # ctx.step_counter is the virtual time. Every message is delivered after the latency of its link, timeouts fire
+    # at their time, and idle agents get a chance to start an action at every whole time unit (as in every step).
+    # Each step jumps straight to the next time anything happens, so quiet periods cost nothing.
+
+    def __init__(self, ctx: SimulationContext = None, latency: LatencyModel = None):
+        super().__init__(ctx)
+        self.latency = latency if latency is not None else LatencyModel(self.ctx, self.rng)
+        self.msgs_queue = EventQueue(self.latency, lambda: self.ctx.step_counter)
+        self.timers = TimeoutHeap()
+
+    def next_tick(self):
+        # The next whole time unit, if an idle agent may start an action at it
+        if self.ctx.READ_FROM_LOG:
+            next_i = self.next_replay_agent()
+            can_initiate = next_i is not None and next_i in self.idle_agents
+        else:
+            can_initiate = len(self.initiating_agents()) > 0
+        return math.floor(self.ctx.step_counter) + 1 if can_initiate else None
+
+    def next_event_time(self):
+        times = [time for time in (self.msgs_queue.next_time(), self.timers.next_time(), self.next_tick()) if time is not None]
+        return min(times) if times else None
+
+    def step(self):
+        # Move to the next event time and run everything that happens at it. False if nothing can happen anymore
+        time = self.next_event_time()
+        if time is None:
+            return False
+        self.ctx.step_counter = time
+        if self.ctx.tracer.debug:
+            self.ctx.tracer.emit('step')
+
+        inboxes = self.group_by_receiver(self.msgs_queue.pop_until(time))
+        to_step = [self.agent_order[receiver_id] for receiver_id in inboxes]
+        due = self.due_agents()
+        to_step += due
+
+        if time == math.floor(time):
+            # A whole time unit: every stepped agent may act, like in a lockstep step
+            to_step += self.initiating_agents()
+            self.step_agents(to_step, inboxes)
+        else:
+            # Between time units, agents only handle their messages and their timeouts
+            self.step_agents(to_step, inboxes, set(due))
+        return True
+
+    def run_until(self, time):
+        # Run the events up to the time (included)
+        while True:
+            next_time = self.next_event_time()
+            if next_time is None or next_time > time:
+                break
+            self.step()
+        self.ctx.step_counter = max(self.ctx.step_counter, time)
+
+
+def pay_latencies(action_log) -> List[float]:
+    # Virtual time from the start to the finish of every PAY in the action log (of the run writing it).
+    # With pipelining PAYs finish out of order, so a finish is matched with its start by the key of its PAY
+    started = {}
+    latencies = []
+    for agent_id, time, action_type, action_msg in action_log:
+        if action_type == ActionType.PAY_START:
+            started[(agent_id, Agent.get_pay_key(action_msg.content))] = time
+        elif action_type == ActionType.PAY_FINISH and action_msg is not None:
+            start = started.pop((agent_id, Agent.get_pay_key(action_msg.content)), None)
+            if start is not None:
+                latencies.append(time - start)
+    return latencies
@@ -0,0 +1,110 @@
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import hashlib
+import mmap
+import uuid
+
+from interfaces import Message
+
+
+class IdProvider(ABC):
+    # Hands out the ids of the agents and tokens of one simulation, in a reproducible order
+    # True if the ids are only used internally and are shown to the user by name(id)
+    names_ids = False
+
+    @abstractmethod
+    def next_id(self):
+        pass
+
+    # The name an id is shown (and serialized) by
+    def name(self, id):
+        return id
+
+
+class FileIdProvider(IdProvider):
+    # Ids pre-generated into a file, one per line (see create_ids.py).
+    # The file is memory-mapped and read lazily from its end, so only the ids in use are ever read. The last line
+    # is given first, like popping from the list of lines (the recorded action logs depend on this order).
+    # The file is mapped once per process (see map_ids_file), and every provider only keeps its own position in it.
+
+    def __init__(self, path='ids.txt'):
+        self.mm = map_ids_file(path)
+        self.end = self.find_end(len(self.mm))
+
+    def find_end(self, end):
+        # Skip the whitespace at the end of what is left
+        while end > 0 and self.mm[end - 1:end].isspace():
+            end -= 1
+        return end
+
+    def next_id(self):
+        if self.end == 0:
+            raise IndexError('No ids left in the ids file')
+        start = self.mm.rfind(b'\n', 0, self.end) + 1
+        id = self.mm[start:self.end].decode()
+        self.end = self.find_end(start)
+        return id
+
+
+@lru_cache(maxsize=None)
+def map_ids_file(path) -> mmap.mmap:
+    # The read-only mapping of the ids file, shared by all the simulations of the process (and their threads).
+    # It stays mapped until the process exits
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class SeededIdProvider(IdProvider):
+    # UUID shaped ids hashed from (seed, counter). No file and no limit, and the same seed gives the same ids,
+    # which both runs of a simulation pair need since the action log refers to agents by id
+
+    def __init__(self, seed=None):
+        self.seed = seed if seed is not None else 0
+        self.counter = 0
+
+    def next_id(self):
+        self.counter += 1
+        return self.id_at(self.counter)
+
+    def id_at(self, counter):
+        # The id given at the counter-th call, without giving all the ones before it
+        digest = hashlib.blake2b(f'{self.seed}:{counter}'.encode(), digest_size=16).digest()
+        return str(uuid.UUID(bytes=digest, version=4))
+
+
+class IntegerIdProvider(IdProvider):
+    # Compact integer ids. They start above the broadcast receivers (and the owner 0 of GET_TOKENS) to not collide with them.
+    # Ids are small ints everywhere inside the simulation (dict keys, owners, senders, upon keys), and are given
+    # UUID shaped display names by `names` only when reported.
+    FIRST_ID = max(Message.BROADCAST_ALL, Message.BROADCAST_SERVER, Message.BROADCAST_CLIENT) + 1
+
+    def __init__(self, names: SeededIdProvider = None, first_id=FIRST_ID):
+        self.first_id = first_id
+        self.next = first_id
+        self.names = names
+        self.names_ids = names is not None
+        self.names_cache = {}
+
+    def next_id(self):
+        id = self.next
+        self.next += 1
+        return id
+
+    def name(self, id):
+        # Broadcast receivers, owner 0 and None are not ids of ours
+        if self.names is None or not isinstance(id, int) or id < self.first_id:
+            return id
+        name = self.names_cache.get(id)
+        if name is None:
+            name = self.names_cache[id] = self.names.id_at(id - self.first_id + 1)
+        return name
+
+
+def make_id_provider(id_mode, seed=None, ids_file='ids.txt') -> IdProvider:
+    if id_mode == 'file':
+        return FileIdProvider(ids_file)
+    elif id_mode == 'seeded':
+        return SeededIdProvider(seed)
+    elif id_mode == 'int':
+        return IntegerIdProvider(SeededIdProvider(seed))
+    raise ValueError(f'Unknown id mode: {id_mode}')
@@ -1,17 +1,29 @@
 import uuid
 from enum import Enum
 
-import simulation_state
+def set_slots_state(obj, state):
+    # Pickled state is either the __dict__ of an object without __slots__, or (None, slots values)
+    if isinstance(state, tuple):
+        state = state[1]
+    for name, value in state.items():
+        setattr(obj, name, value)
 
 class AgentRole(Enum):
     CLIENT = 1
     SERVER = 2
 
 class Token:
-    def __init__(self):
-        self.id = simulation_state.IDS.pop()
-        self.version = 0
-        self.owner = None
+    # Tokens are shared between agents and messages, so they are never changed in place. A change is a new Token
+    __slots__ = ('id', 'version', 'owner')
+
+    def __init__(self, id, version=0, owner=None):
+        self.id = id
+        self.version = version
+        self.owner = owner
+
+    def __setstate__(self, state):
+        # Also loads tokens pickled before Token had __slots__
+        set_slots_state(self, state)
 
     @staticmethod
     def generate_id():
@@ -42,6 +54,9 @@ class MessageType(Enum):
     TURNED_TO_SERVER = 8
 
 class Message:
+    # Messages are shared between all the receivers of a broadcast, so they are never changed after being sent
+    __slots__ = ('type', 'sender_id', 'receiver_id', 'content')
+
     BROADCAST_ALL    = 0
     BROADCAST_SERVER = 1
     BROADCAST_CLIENT = 2
@@ -52,5 +67,9 @@ class Message:
         self.receiver_id = receiver_id
         self.content = content
 
+    def __setstate__(self, state):
+        # Also loads messages pickled before Message had __slots__ (e.g. lin_test.pkl)
+        set_slots_state(self, state)
+
     def __str__(self):
         return f"Type: {self.type}, From: {self.sender_id}, To: {self.receiver_id}, Content: {self.content}"
\ No newline at end of file
@@ -1,128 +1,178 @@
 #!/usr/bin/env python3
-import copy
 import pickle
 
+from action_log_file import ActionLogFile, ActionLogWriter
 from interfaces import AgentRole, MessageType
+from event_engine import EventSimulator, pay_latencies
 from simulator import Simulator
 import simulation_state
+from simulation_state import SimulationContext
+from tracing import short_id
 
 
-def run_simulation_test():
-    sim = Simulator()
-    simulation_state.step_counter = 0
+def run_simulation_test(ctx: SimulationContext):
+    sim = EventSimulator(ctx) if ctx.ENGINE == 'event' else Simulator(ctx)
+    ctx.step_counter = 0
 
     # Print starting state
     print("Start:")
-    print_summary()
+    print_summary(ctx)
 
+    if ctx.ENGINE == 'event':
+        run_events(ctx, sim)
+    else:
+        run_steps(ctx, sim)
+
+    # Print final state
+    print("End:")
+    print_summary(ctx)
+
+    # Print the log
+    print_action_log(ctx)
+
+    if ctx.ENGINE == 'event' and ctx.WRITE_TO_LOG:
+        print_pay_latencies(ctx)
+
+    return compute_final_db(ctx)
+
+def run_steps(ctx: SimulationContext, sim: Simulator):
     # Run steps until close
-    for _ in range(simulation_state.STEPS_UNTIL_CLOSE):
-        simulation_state.step_counter += 1
-        print(f'--------- Step #{simulation_state.step_counter + 1} ---------')
+    for _ in range(ctx.STEPS_UNTIL_CLOSE):
+        ctx.step_counter += 1
+        if ctx.tracer.debug:
+            ctx.tracer.emit('step')
         sim.step()
 
     # Call close
-    if not simulation_state.LOG_RUN:
-        print('==>==>==>==>==> CALLED CLOSED - NO MORE NEW ACTIONS <==<==<==<==<==')
+    if not ctx.LOG_RUN:
+        if ctx.tracer.info:
+            ctx.tracer.emit('closed')
         sim.close()
 
     # Run steps until finish
-    while sim.msgs_queue or (simulation_state.LOG_RUN and len(simulation_state.action_log) > 0):
-        simulation_state.step_counter += 1
-        if simulation_state.step_counter > simulation_state.STEPS_UNTIL_INFTY_LOOP:
-            print('Infinite loop detected. Exiting...')
+    while sim.has_pending_work():
+        ctx.step_counter += 1
+        if ctx.step_counter > ctx.STEPS_UNTIL_INFTY_LOOP:
+            if ctx.tracer.info:
+                ctx.tracer.emit('infinite_loop')
             break
-        print(f'--------- Step #{simulation_state.step_counter + 1} ---------')
+        if ctx.tracer.debug:
+            ctx.tracer.emit('step')
         sim.step()
 
-    # Print final state
-    print("End:")
-    print_summary()
+def run_events(ctx: SimulationContext, sim: EventSimulator):
+    # Run in virtual time until close
+    sim.run_until(ctx.STEPS_UNTIL_CLOSE)
 
-    # Print the log
-    print_action_log()
-
-    return compute_final_db()
-
-def compute_final_db():
-    final_db = {}
-    for server in simulation_state.servers.values():
-        for token_id, token in server.tokens_db.items():
-            if token_id not in final_db:
-                final_db[token_id] = copy.deepcopy(token)
-            elif token.version > final_db[token_id].version:
-                final_db[token_id] = copy.deepcopy(token)
+    # Call close
+    if not ctx.LOG_RUN:
+        if ctx.tracer.info:
+            ctx.tracer.emit('closed')
+        sim.close()
+
+    # Run events until finish
+    while sim.has_pending_work():
+        if ctx.step_counter > ctx.STEPS_UNTIL_INFTY_LOOP:
+            if ctx.tracer.info:
+                ctx.tracer.emit('infinite_loop')
+            break
+        if not sim.step():
+            break
+
+def compute_final_db(ctx: SimulationContext):
+    # The highest version of every token among all the servers.
+    # The servers share the base of their DBs, so it is read once, followed by what every server changed on top of it
+    servers = list(ctx.servers.values())
+    if not servers:
+        return {}
+    final_db = dict(servers[0].tokens_db.base)
+    for server in servers:
+        for token in server.tokens_db.changed_tokens():
+            current = final_db.get(token.id)
+            if current is None or token.version > current.version:
+                final_db[token.id] = token
     return final_db
 
 def check_safety(token_db_1, token_db_2):
     if len(token_db_1) != len(token_db_2):
         print('Safety DOESN\'T hold... :( :: Not Same Length.')
         return False
-    elif set(token_db_1.keys()) != set(token_db_2.keys()):
+    elif token_db_1.keys() != token_db_2.keys():
         print('Safety DOESN\'T hold... :( :: Not equal token lists.')
         return False
 
-    for token_id in token_db_1.keys():
-        if token_db_1[token_id].id != token_db_2[token_id].id:
-            print('Safety DOESN\'T hold... :( :: ID Missmatch')
-            return False
-        elif token_db_1[token_id].version != token_db_2[token_id].version:
+    for token_id, token in token_db_1.items():
+        other = token_db_2[token_id]
+        if token.version != other.version:
             print('Safety DOESN\'T hold... :( ::  Version Missmatch')
             return False
-        elif token_db_1[token_id].owner != token_db_2[token_id].owner:
+        elif token.owner != other.owner:
             print('Safety DOESN\'T hold... :( :: Owner Missmatch')
             return False
 
     print('Safety HOLDS!!! :)')
     return True
 
-def print_step_summary():
+def print_step_summary(ctx: SimulationContext):
     print(f'\n :: Step Summary :: \n'
-          f'    Num Servers: {len(simulation_state.servers)}\n'
-          f'    Num Clients: {len(simulation_state.clients)}\n'
-          f'    Faulty: {simulation_state.faulty_counter}\n'
+          f'    Num Servers: {len(ctx.servers)}\n'
+          f'    Num Clients: {len(ctx.clients)}\n'
+          f'    Faulty: {ctx.faulty_counter}\n'
           f' :: :::::::::::: :: ')
     print('\n\n')
 
 
-def print_summary():
+def print_summary(ctx: SimulationContext):
     print("\n---------- SUMMARY ----------")
-    print(f"Num Servers: {len(simulation_state.servers)}")
-    print(f"Num Clients: {len(simulation_state.clients)}")
-    print(f"Faulty: {simulation_state.faulty_counter}")
+    print(f"Num Servers: {len(ctx.servers)}")
+    print(f"Num Clients: {len(ctx.clients)}")
+    print(f"Faulty: {ctx.faulty_counter}")
     print("---------- ---------- ----------\n")
-    for agent in simulation_state.get_all_agents():
+    for agent in ctx.get_all_agents():
         if agent.role == AgentRole.CLIENT:
-            print(f"Client: {agent.id}")
+            print(f"Client: {ctx.id_name(agent.id)}")
         elif agent.role == AgentRole.SERVER:
-            print(f"Server: {agent.id}")
-        print(f"Tokens: {[token.id for token in agent.my_tokens]}")
+            print(f"Server: {ctx.id_name(agent.id)}")
+        print(f"Tokens: {[ctx.id_name(token.id) for token in agent.my_tokens]}")
 
-def print_action_log():
+def print_action_log(ctx: SimulationContext):
     print("\n---------- Action Log ----------")
-    for action in simulation_state.action_log:
-        print(f"Agent: {action[0]}")
+    action_log = ctx.action_log
+    if ctx.READ_FROM_LOG:
+        # Show what was left of the log
+        progress = ctx.replay.progress()
+        print(f"Replayed: {progress['replayed']}/{progress['total']} actions ({progress['percent']:.1f}%)")
+        action_log = ctx.replay.remaining_entries()
+    for action in action_log:
+        print(f"Agent: {ctx.id_name(action[0])}")
         print(f"Timestamp: {action[2]}")
         print(f"Action: {action[1]}")
         print("-----------------------------")
     print("---------- ---------- ----------\n")
 
-def check_liveness():
+def print_pay_latencies(ctx: SimulationContext):
+    latencies = sorted(pay_latencies(ctx.action_log))
+    if not latencies:
+        return
+    print(f"PAY latency (virtual time): mean {sum(latencies) / len(latencies):.2f}, "
+          f"median {latencies[len(latencies) // 2]:.2f}, max {latencies[-1]:.2f} over {len(latencies)} PAYs\n")
+
+def check_liveness(ctx: SimulationContext):
     # Liveness holds if the clients finished the execution of all the actions it performed.
     # That is, if the during_action property is True then an execution of some action has not finished.
     print('\n########## Liveness Assessment ##########')
 
     any_not_liveness = False
-    for client in list(simulation_state.clients.values()):
+    for client in list(ctx.clients.values()):
         if client.is_faulty:
-            print(f'Client ...{client.id[-4:]} is faulty ------------------------> LIVENESS IRRELEVANT')
+            print(f'Client ...{short_id(ctx.id_name(client.id))} is faulty ------------------------> LIVENESS IRRELEVANT')
         else:
             if client.during_action:
                 any_not_liveness = True
-                print(f'Client ...{client.id[-4:]} did NOT finished all executions --> LIVENESS DOESN\'T HOLD')
-                print(f'Client has the following upons: {[entry[0].__name__ for entry in client.upon_registry]}')
+                print(f'Client ...{short_id(ctx.id_name(client.id))} did NOT finished all executions --> LIVENESS DOESN\'T HOLD')
+                print(f'Client has the following upons: {[upon.func_to_run.__name__ for upon in client.upon_registry]}')
             else:
-                print(f'Client ...{client.id[-4:]} finished all executions ----------> LIVENESS HOLDS')
+                print(f'Client ...{short_id(ctx.id_name(client.id))} finished all executions ----------> LIVENESS HOLDS')
 
     if any_not_liveness:
         print('\n====> LIVENESS Property DOESN\'T HOLD... :(\n')
@@ -132,129 +182,138 @@ def check_liveness():
         return True
 
 
-liveness_results = []
-safety_results = []
+# Configs of the run with omissions
+OMISSIONS_RUN_CONFIGS = dict(
+    LOG_RUN=0,
+    ALLOW_FAULTY=True, #True
+    CLIENT_GET_RATE=0,
+    CLIENT_PAY_RATE=0.5,
+    CLIENT_OMISSION_RATE=0.1, #0.3
+    SERVER_OMISSION_RATE=0.8,
+    CLIENT_TRANSFORM_RATE=0.1,
+    SERVER_TRANSFORM_RATE=0.1,
+)
+
+# Configs of the run withOUT omissions, replaying the log of the run with omissions
+NO_OMISSIONS_RUN_CONFIGS = dict(
+    LOG_RUN=1,
+    ALLOW_FAULTY=False,
+    CLIENT_GET_RATE=0,
+    CLIENT_PAY_RATE=0.5,
+    CLIENT_OMISSION_RATE=0,  # 0.3
+    SERVER_OMISSION_RATE=0,  # 0.8
+    CLIENT_TRANSFORM_RATE=0.1,  # 0.1
+    SERVER_TRANSFORM_RATE=0.1,  # 0.1
+)
+
+def run_simulation_pair(seed=None, **configs):
+    # Runs a random simulation with omissions, then replays its action log without omissions.
+    # configs override the configs of both runs (e.g. TRACE_LEVEL).
+    # Returns (liveness with omissions, liveness without omissions, safety)
+
+    """
+    Run with omissions
+    """
+    ctx = SimulationContext(seed, **dict(OMISSIONS_RUN_CONFIGS, **configs))
+
+    final_db_omissions = run_simulation_test(ctx)
+
+    # Liveness and Safety Checks
+    liveness_omissions = check_liveness(ctx)
+
+    """
+    Run withOUT omissions
+    """
+    if isinstance(ctx.action_log, ActionLogWriter):
+        # The log was streamed into its file, so it is replayed from there
+        ctx.action_log.close()
+        action_log = ActionLogFile(ctx.ACTION_LOG_FILE)
+    else:
+        action_log = list(ctx.action_log)
+    ctx = SimulationContext(seed, action_log, **dict(NO_OMISSIONS_RUN_CONFIGS, **configs))
 
-for sim_counter in range(simulation_state.NUM_SIMULATIONS):
-    print(f'~~~~~~~~~~ SIMULATION #{sim_counter + 1} ~~~~~~~~~~')
+    try:
+        final_db_no_omissions = run_simulation_test(ctx)
 
+        liveness_no_omissions = check_liveness(ctx)
+    finally:
+        if isinstance(action_log, ActionLogFile):
+            action_log.close()
+
+    safety = check_safety(final_db_omissions, final_db_no_omissions)
+
+    return liveness_omissions, liveness_no_omissions, safety
+
+def run_linearization_test():
+    # Scenario 1:
+    #   Client A initiates GET_TOKENS request
+    #   Client B initiates PAY request
+    #   Client B's PAY requests reaches the linearizability point
+    #   Client A's GET_TOKENS request finishes
+    #   Client B's PAY request finishes.
+    #
+    # Scenario 2:
+    #   Client A initiates GET_TOKENS request
+    #   Client B initiates PAY request
+    #   Client B's PAY requests reaches the linearizability point
+    #   Client B's PAY request finishes.
+    #   Client A's GET_TOKENS request finishes
+    #
+    lin_test_scenario_a_log, lin_test_scenario_b_log = pickle.load(open('lin_test.pkl', 'rb'))
     """
     Run with omissions
     """
-    simulation_state.LOG_RUN = 0
-    simulation_state.READ_FROM_LOG = simulation_state.LOG_RUN
-    simulation_state.WRITE_TO_LOG = 1 - simulation_state.READ_FROM_LOG
-    simulation_state.ALLOW_FAULTY = True #True
-    simulation_state.CLIENT_GET_RATE = 0
-    simulation_state.CLIENT_PAY_RATE = 0.5
-    simulation_state.CLIENT_OMISSION_RATE = 0.1 #0.3
-    simulation_state.SERVER_OMISSION_RATE = 0.8
-    simulation_state.CLIENT_TRANSFORM_RATE = 0.1
-    simulation_state.SERVER_TRANSFORM_RATE = 0.1
-
-    final_db_omissions = run_simulation_test()
+    ctx = SimulationContext(action_log=lin_test_scenario_a_log, **dict(OMISSIONS_RUN_CONFIGS, LOG_RUN=1, CLIENT_PAY_RATE=0.3))
+
+    final_db_omissions = run_simulation_test(ctx)
 
     # Liveness and Safety Checks
-    liveness = check_liveness()
-    liveness_results.append(liveness)
+    liveness_omissions = check_liveness(ctx)
 
     """
     Run withOUT omissions
     """
-    simulation_state.LOG_RUN = 1
-    simulation_state.READ_FROM_LOG = simulation_state.LOG_RUN
-    simulation_state.WRITE_TO_LOG = 1 - simulation_state.READ_FROM_LOG
-    simulation_state.ALLOW_FAULTY = False
-    simulation_state.CLIENT_GET_RATE = 0
-    simulation_state.CLIENT_PAY_RATE = 0.5
-    simulation_state.CLIENT_OMISSION_RATE = 0  # 0.3
-    simulation_state.SERVER_OMISSION_RATE = 0  # 0.8
-    CLIENT_TRANSFORM_RATE = 0.1  # 0.1
-    SERVER_TRANSFORM_RATE = 0.1  # 0.1
-
-    final_db_no_omissions = run_simulation_test()
-
-    liveness = check_liveness()
-    liveness_results.append(liveness)
+    ctx = SimulationContext(action_log=lin_test_scenario_b_log, **dict(NO_OMISSIONS_RUN_CONFIGS, CLIENT_PAY_RATE=0.3))
+
+    final_db_no_omissions = run_simulation_test(ctx)
+
+    liveness_no_omissions = check_liveness(ctx)
 
     safety = check_safety(final_db_omissions, final_db_no_omissions)
-    safety_results.append(safety)
 
+    return liveness_omissions, liveness_no_omissions, safety
+
+def print_results(liveness_results, safety_results):
+    print()
+    print('-'*100)
+    print()
+
+    if all(liveness_results):
+        print('Liveness HOLDS for ALL simulations!!! :)')
+    else:
+        print('Liveness DOESN\'T hold for some simulations... :(')
+
+    if all(safety_results):
+        print('Safety HOLDS for ALL simulations!!! :)')
+    else:
+        print('Safety DOESN\'T hold for some simulations... :(')
+
+
+if __name__ == '__main__':
+    liveness_results = []
+    safety_results = []
+
+    for sim_counter in range(simulation_state.NUM_SIMULATIONS):
+        print(f'~~~~~~~~~~ SIMULATION #{sim_counter + 1} ~~~~~~~~~~')
+
+        liveness_omissions, liveness_no_omissions, safety = run_simulation_pair()
+        liveness_results += [liveness_omissions, liveness_no_omissions]
+        safety_results.append(safety)
+
+    # ############### Linearization Test ###############
+    print('############### Linearization Test ###############')
+    liveness_omissions, liveness_no_omissions, safety = run_linearization_test()
+    liveness_results += [liveness_omissions, liveness_no_omissions]
+    safety_results.append(safety)
 
-# ############### Linearization Test ###############
-print('############### Linearization Test ###############')
-# Scenario 1:
-#   Client A initiates GET_TOKENS request
-#   Client B initiates PAY request
-#   Client B's PAY requests reaches the linearizability point
-#   Client A's GET_TOKENS request finishes
-#   Client B's PAY request finishes.
-#
-# Scenario 2:
-#   Client A initiates GET_TOKENS request
-#   Client B initiates PAY request
-#   Client B's PAY requests reaches the linearizability point
-#   Client B's PAY request finishes.
-#   Client A's GET_TOKENS request finishes
-#
-lin_test_scenario_a_log, lin_test_scenario_b_log = pickle.load(open('lin_test.pkl', 'rb'))
-"""
-Run with omissions
-"""
-simulation_state.LOG_RUN = 1
-simulation_state.READ_FROM_LOG = simulation_state.LOG_RUN
-simulation_state.WRITE_TO_LOG = 1 - simulation_state.READ_FROM_LOG
-simulation_state.ALLOW_FAULTY = True #True
-simulation_state.CLIENT_GET_RATE = 0
-simulation_state.CLIENT_PAY_RATE = 0.3
-simulation_state.CLIENT_OMISSION_RATE = 0.1 #0.3
-simulation_state.SERVER_OMISSION_RATE = 0.8
-simulation_state.CLIENT_TRANSFORM_RATE = 0.1
-simulation_state.SERVER_TRANSFORM_RATE = 0.1
-
-simulation_state.action_log = lin_test_scenario_a_log
-
-final_db_omissions = run_simulation_test()
-
-# Liveness and Safety Checks
-liveness = check_liveness()
-liveness_results.append(liveness)
-
-"""
-Run withOUT omissions
-"""
-simulation_state.LOG_RUN = 1
-simulation_state.READ_FROM_LOG = simulation_state.LOG_RUN
-simulation_state.WRITE_TO_LOG = 1 - simulation_state.READ_FROM_LOG
-simulation_state.ALLOW_FAULTY = False
-simulation_state.CLIENT_GET_RATE = 0
-simulation_state.CLIENT_PAY_RATE = 0.3
-simulation_state.CLIENT_OMISSION_RATE = 0  # 0.3
-simulation_state.SERVER_OMISSION_RATE = 0  # 0.8
-CLIENT_TRANSFORM_RATE = 0.1  # 0.1
-SERVER_TRANSFORM_RATE = 0.1  # 0.1
-
-simulation_state.action_log = lin_test_scenario_b_log
-
-final_db_no_omissions = run_simulation_test()
-
-liveness = check_liveness()
-liveness_results.append(liveness)
-
-safety = check_safety(final_db_omissions, final_db_no_omissions)
-safety_results.append(safety)
-
-
-print()
-print('-'*100)
-print()
-
-if all(liveness_results):
-    print('Liveness HOLDS for ALL simulations!!! :)')
-else:
-    print('Liveness DOESN\'T hold for some simulations... :(')
-
-if all(safety_results):
-    print('Safety HOLDS for ALL simulations!!! :)')
-else:
-    print('Safety DOESN\'T hold for some simulations... :(')
\ No newline at end of file
+    print_results(liveness_results, safety_results)
@@ -0,0 +1,37 @@
+import random
+from typing import Any, List
+
+
+class MessagePool:
+    # Pool of messages (or any other items, e.g. (receiver_id, msg) deliveries) waiting to be delivered.
+    # Picking a message swaps it with the last one and pops, so choosing k random messages costs O(k)
+    # no matter how many messages are pending.
+
+    def __init__(self, rng: random.Random = None):
+        self.rng = rng if rng is not None else random.Random()
+        self.msgs = []
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+    def add(self, msg: Any):
+        self.msgs.append(msg)
+
+    def pop_random(self) -> Any:
+        # Swap the chosen message with the last one, then pop the last one
+        i = self.rng.randrange(len(self.msgs))
+        last = self.msgs.pop()
+        if i == len(self.msgs):
+            return last
+
+        chosen = self.msgs[i]
+        self.msgs[i] = last
+        return chosen
+
+    def sample(self, k) -> List[Any]:
+        # Remove and return up to k random messages, every order being equally likely
+        k = min(k, len(self.msgs))
+        return [self.pop_random() for _ in range(k)]
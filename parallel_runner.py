@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import os
+
+import main
+from schedulers import SCHEDULERS
+import simulation_state
+from tracing import TraceLevel
+
+
+def run_seeded_pair(seed, verbose=False, scheduler=simulation_state.SCHEDULER):
+    # Runs in a worker process. The seed drives both the agents' random choices and the message scheduler.
+    if verbose:
+        liveness_omissions, liveness_no_omissions, safety = main.run_simulation_pair(seed, SCHEDULER=scheduler)
+    else:
+        # No tracing at all, and the reports of the runs are dropped
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            liveness_omissions, liveness_no_omissions, safety = main.run_simulation_pair(seed, SCHEDULER=scheduler,
+                                                                                         TRACE_LEVEL=TraceLevel.OFF)
+
+    return seed, liveness_omissions, liveness_no_omissions, safety
+
+
+def run_parallel(num_simulations, workers=None, base_seed=0, verbose=False, scheduler=simulation_state.SCHEDULER):
+    seeds = [base_seed + i for i in range(num_simulations)]
+    report = {
+        'simulations': num_simulations,
+        'liveness_held': 0,
+        'safety_held': 0,
+        'liveness_failed_seeds': [],
+        'safety_failed_seeds': [],
+    }
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(run_seeded_pair, seeds, [verbose] * len(seeds), [scheduler] * len(seeds))
+
+        for seed, liveness_omissions, liveness_no_omissions, safety in results:
+            if liveness_omissions and liveness_no_omissions:
+                report['liveness_held'] += 1
+            else:
+                report['liveness_failed_seeds'].append(seed)
+
+            if safety:
+                report['safety_held'] += 1
+            else:
+                report['safety_failed_seeds'].append(seed)
+
+    return report
+
+
+def print_report(report):
+    print('\n---------- PARALLEL SIMULATIONS REPORT ----------')
+    print(f"Simulations: {report['simulations']}")
+    print(f"Liveness held: {report['liveness_held']}/{report['simulations']}")
+    print(f"Safety held: {report['safety_held']}/{report['simulations']}")
+    if report['liveness_failed_seeds']:
+        print(f"Liveness failed for seeds: {report['liveness_failed_seeds']}")
+    if report['safety_failed_seeds']:
+        print(f"Safety failed for seeds: {report['safety_failed_seeds']}")
+    print('---------- ---------- ----------\n')
+
+    main.print_results([report['liveness_held'] == report['simulations']],
+                       [report['safety_held'] == report['simulations']])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run independent simulation pairs in parallel worker processes.')
+    parser.add_argument('--simulations', type=int, default=simulation_state.NUM_SIMULATIONS)
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first simulation, the others follow it')
+    parser.add_argument('--verbose', action='store_true', help='Keep the simulations output')
+    parser.add_argument('--scheduler', choices=sorted(SCHEDULERS), default=simulation_state.SCHEDULER,
+                        help='Delivery order of the messages')
+    args = parser.parse_args()
+
+    print_report(run_parallel(args.simulations, args.workers, args.seed, args.verbose, args.scheduler))
@@ -0,0 +1,159 @@
+from abc import ABC, abstractmethod
+from collections import deque
+import heapq
+import itertools
+import random
+from typing import Callable, List, Tuple
+
+from interfaces import Message, MessageType
+from message_pool import MessagePool
+
+
+def make_rng(rng) -> random.Random:
+    # Accept either a ready random.Random or a seed to build one from
+    if isinstance(rng, random.Random):
+        return rng
+    return random.Random(rng)
+
+
+# A message on its way to one receiver. The message itself is shared by all the receivers of a broadcast
+Delivery = Tuple[str, Message]
+
+
+class Scheduler(ABC):
+    # Decides which pending (receiver_id, msg) deliveries are made in every step.
+    # Every scheduler draws only from its own random.Random, so the same seed replays the same schedule.
+
+    def __init__(self, rng=None):
+        self.rng = make_rng(rng)
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def add(self, receiver_id, msg: Message):
+        pass
+
+    # Remove and return up to k deliveries to make in the current step
+    @abstractmethod
+    def choose(self, k) -> List[Delivery]:
+        pass
+
+
+class UniformRandomScheduler(Scheduler):
+    # Every pending message is equally likely to be delivered (the original simulator behaviour)
+
+    def __init__(self, rng=None):
+        super().__init__(rng)
+        self.pool = MessagePool(self.rng)
+
+    def __len__(self):
+        return len(self.pool)
+
+    def add(self, receiver_id, msg: Message):
+        self.pool.add((receiver_id, msg))
+
+    def choose(self, k) -> List[Delivery]:
+        return self.pool.sample(k)
+
+
+class FifoScheduler(Scheduler):
+    # Messages are delivered in the order they were sent
+
+    def __init__(self, rng=None):
+        super().__init__(rng)
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, receiver_id, msg: Message):
+        self.queue.append((receiver_id, msg))
+
+    def choose(self, k) -> List[Delivery]:
+        k = min(k, len(self.queue))
+        return [self.queue.popleft() for _ in range(k)]
+
+
+class LinkLatencyScheduler(Scheduler):
+    # Every (sender, receiver) link gets a fixed latency in steps, drawn once from [min_latency, max_latency].
+    # A message can only be delivered after its link latency passed, and ready messages are delivered by age.
+    # link_latency(sender_id, receiver_id, rng) can be given to choose the latencies instead.
+
+    def __init__(self, rng=None, min_latency=0, max_latency=5, link_latency: Callable = None):
+        super().__init__(rng)
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.link_latency = link_latency
+        self.latencies = {}
+        self.now = 0
+        self.heap = []
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def get_latency(self, sender_id, receiver_id):
+        link = (sender_id, receiver_id)
+        if link not in self.latencies:
+            if self.link_latency is not None:
+                self.latencies[link] = self.link_latency(sender_id, receiver_id, self.rng)
+            else:
+                self.latencies[link] = self.rng.randint(self.min_latency, self.max_latency)
+        return self.latencies[link]
+
+    def add(self, receiver_id, msg: Message):
+        ready_at = self.now + self.get_latency(msg.sender_id, receiver_id)
+        heapq.heappush(self.heap, (ready_at, next(self.seq), (receiver_id, msg)))
+
+    def choose(self, k) -> List[Delivery]:
+        # Every call is one step of time
+        self.now += 1
+
+        to_deliver = []
+        while self.heap and len(to_deliver) < k and self.heap[0][0] <= self.now:
+            to_deliver.append(heapq.heappop(self.heap)[2])
+        return to_deliver
+
+
+class PriorityScheduler(Scheduler):
+    # Adversarial scheduler: always delivers the messages with the lowest priority(msg) first.
+    # Ties are broken randomly, so a seed still picks one exact schedule.
+
+    def __init__(self, rng=None, priority: Callable[[Message], float] = None):
+        super().__init__(rng)
+        self.priority = priority if priority is not None else (lambda msg: 0)
+        self.heap = []
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, receiver_id, msg: Message):
+        heapq.heappush(self.heap, (self.priority(msg), self.rng.random(), next(self.seq), (receiver_id, msg)))
+
+    def choose(self, k) -> List[Delivery]:
+        k = min(k, len(self.heap))
+        return [heapq.heappop(self.heap)[3] for _ in range(k)]
+
+
+def prioritize_types(*msg_types: MessageType) -> Callable[[Message], float]:
+    # Priority function delivering the given message types first, in the given order.
+    # e.g. prioritize_types(MessageType.DB_UPDATE, MessageType.PAY) lets DB_UPDATE overtake racing PAYs
+    ranks = {msg_type: rank for rank, msg_type in enumerate(msg_types)}
+    return lambda msg: ranks.get(msg.type, len(ranks))
+
+
+# Schedulers by their SCHEDULER config name. All of them are built from the simulation's rng alone
+SCHEDULERS = {
+    'uniform': UniformRandomScheduler,
+    'fifo': FifoScheduler,
+    'latency': LinkLatencyScheduler,
+    'priority': PriorityScheduler,
+}
+
+def make_scheduler(name, rng=None) -> Scheduler:
+    if name not in SCHEDULERS:
+        raise ValueError(f'Unknown scheduler: {name}')
+    return SCHEDULERS[name](rng)
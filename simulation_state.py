@@ -1,5 +1,8 @@
 import random
 import interfaces
+from action_log_file import ActionLogWriter
+from action_replay import ActionLogReplay
+from tracing import ConsoleSink, TraceLevel, Tracer
 
 # Configs
 
@@ -20,9 +23,27 @@ NUM_TOTAL_TOKENS = NUM_START_CLIENTS * NUM_TOKENS_PER_CLIENT
 
 # Messages
 MAX_MESSAGES_PER_STEP = 5
+# Delivery order of the pending messages: 'uniform', 'fifo', 'latency' or 'priority' (see schedulers.SCHEDULERS).
+# Used by the lockstep engine, the event engine orders messages by their latencies
+SCHEDULER = 'uniform'
 ACTION_TIMEOUT = 30
-
-# ALLOW_FAULTY = True
+# Backoff of repeated timeouts of the same action: 'fixed', 'exponential' or 'jittered' (see timers.BACKOFFS)
+RETRY_BACKOFF = 'fixed'
+MAX_ACTION_TIMEOUT = 8 * ACTION_TIMEOUT
+# Repeat an action only to the servers that didn't answer it yet, instead of to all of them
+RETRY_TARGETED = False
+
+# Most tokens moved by one PAY (in a single quorum round). 1 sends the classic single token PAY
+PAY_BATCH_SIZE = 1
+# Skip the GET round before a PAY if the client's last GET finished at most this many steps ago (None: never skip)
+PAY_SKIP_GET_MAX_AGE = None
+# Most operations (GET or PAY) a client has in progress at once. PAYs in progress together send different tokens
+PIPELINE_DEPTH = 1
+# Answer a client's GET about an owner from its own DB if a quorum refreshed it at most this many steps ago
+# (None: always ask the servers)
+CLIENT_CACHE_MAX_AGE = None
+
+ALLOW_FAULTY = True
 
 # Rates
 CLIENT_GET_RATE = 0     # 0 -> GET CANNOT HAPPEN RANDOMLY, ONLY AS PART OF PAY.
@@ -35,18 +56,6 @@ SERVER_OMISSION_RATE = 0 # 0.8
 CLIENT_TRANSFORM_RATE = 0.1 # 0.1
 SERVER_TRANSFORM_RATE = 0.1 # 0.1
 
-IDS = None
-
-# Ongoing State
-agents = {}
-servers = {}
-server_transforming_flag = 0 # We allow only one server to transform at a time
-clients = {}
-client_transforming_flag = 0 # We allow only one client to transform at a time
-amount_transforming_into_clients = 0
-faulty_counter = 0 
-step_counter = 0
-
 # Logs
 LOG_RUN = 0
 READ_FROM_LOG = LOG_RUN
@@ -55,80 +64,179 @@ WRITE_TO_LOG = 1 - READ_FROM_LOG
 if LOG_RUN:
     LOG_POP_RATE = 0.5
 
-action_log = [] # list of actions tuple : (agent_id, step, action)
-
-def get_agents_amount():
-    return len(agents.values())
-def get_servers_amount():
-    return len(servers.values())
-def get_clients_amount():
-    return len(clients.values())
-
-def get_n_minus_t_amount():
-    n = get_servers_amount()
-    f = n // 2
-    return n-f
-
-def get_t_plus_one():
-    n = get_servers_amount()
-    f = n // 2
-    return f+1
-
-def get_agent_role_by_id(id):
-    if id in servers:
-        return interfaces.AgentRole.SERVER
-    else:
-        return interfaces.AgentRole.CLIENT
-
-def get_random_server():
-    # Choose a random server from the servers list
-    return random.choice(list(servers.values()))
-def get_random_client():
-    # Choose a random client from the clients list
-    return random.choice(list(clients.values()))
-def get_random_agent():
-    # Choose a random agent from the agents list
-    return random.choice(list(agents.values()))
-
-def get_all_servers():
-    return servers.values()
-def get_all_clients():
-    return clients.values()
-def get_all_agents():
-    return agents.values()
-
-def can_add_server():
-    return len(servers.values()) - server_transforming_flag + client_transforming_flag < MAX_SERVERS
-def can_remove_server():
-    return len(servers.values()) - server_transforming_flag + client_transforming_flag > MIN_SERVERS
-def can_add_faulty_server():
-    return (faulty_counter + 1) < len(servers.values()) / 2
-
-def update_lists(changed_agent):
-    if changed_agent.role == interfaces.AgentRole.CLIENT:
-        clients.pop(changed_agent.id)
-        servers[changed_agent.id] = changed_agent
-    elif changed_agent.role == interfaces.AgentRole.SERVER:
-        servers.pop(changed_agent.id)
-        clients[changed_agent.id] = changed_agent
-
-
-# Helper functions for calculating linearizability of PAY actions
-ongoing_pay_actions = {}
-
-def mark_pay_start(agent_id, step):
-    ongoing_pay_actions[agent_id] = [step, 0]
-
-def mark_pay_answer(agent_id, step):
-    # If the agent is not in the ongoing pay actions, ignore the message
-    if agent_id not in ongoing_pay_actions:
-        return
-
-    ongoing_pay_actions[agent_id][1] += 1
-
-    # Check if enough servers answered - meaning this is the linearization point
-    if ongoing_pay_actions[agent_id][1] == get_n_minus_t_amount():
-        ongoing_pay_actions.pop(agent_id)
-        
-        # Log the linearization point
-        agents[agent_id].log_action(interfaces.ActionType.PAY_LINEARIZATION)
+# Stream the action log of the run writing it into this file (see action_log_file.py), instead of keeping it in memory
+ACTION_LOG_FILE = None
+
+# Engine: 'lockstep' (simulator.Simulator) or 'event' (event_engine.EventSimulator, with virtual time).
+# With the event engine the steps configs are in virtual time units, and messages take MEAN_LATENCY units on average
+ENGINE = 'lockstep'
+MEAN_LATENCY = 1.0
+
+# Ids of the agents and tokens: 'file' (IDS_FILE, pre-generated by create_ids.py), 'seeded' (hashed from the seed) or 'int'
+ID_MODE = 'file'
+IDS_FILE = 'ids.txt'
+
+# Tracing of the simulation events, printed to the console by default
+TRACE_LEVEL = TraceLevel.DEBUG
+
+# Configs that can be overridden per simulation, the module values above are the defaults
+CONFIG_NAMES = [
+    'STEPS_UNTIL_CLOSE', 'STEPS_UNTIL_INFTY_LOOP',
+    'MIN_SERVERS', 'MAX_SERVERS', 'NUM_START_CLIENTS', 'NUM_START_SERVERS',
+    'NUM_TOKENS_PER_CLIENT', 'NUM_TOTAL_TOKENS',
+    'MAX_MESSAGES_PER_STEP', 'SCHEDULER', 'ACTION_TIMEOUT', 'RETRY_BACKOFF', 'MAX_ACTION_TIMEOUT', 'RETRY_TARGETED',
+    'PAY_BATCH_SIZE', 'PAY_SKIP_GET_MAX_AGE', 'PIPELINE_DEPTH', 'CLIENT_CACHE_MAX_AGE',
+    'ALLOW_FAULTY',
+    'CLIENT_GET_RATE', 'CLIENT_PAY_RATE', 'CLIENT_NONE_RATE',
+    'CLIENT_OMISSION_RATE', 'SERVER_OMISSION_RATE',
+    'CLIENT_TRANSFORM_RATE', 'SERVER_TRANSFORM_RATE',
+    'LOG_RUN', 'ACTION_LOG_FILE',
+    'ENGINE', 'MEAN_LATENCY',
+    'ID_MODE', 'IDS_FILE',
+    'TRACE_LEVEL',
+]
+
+
+class SimulationContext:
+    # All the state of a single simulation. Owned by the Simulator and handed to every Agent,
+    # so any number of simulations can exist side by side in one interpreter.
+
+    def __init__(self, seed=None, action_log=None, tracer: Tracer = None, **configs):
+        # Configs
+        for name in CONFIG_NAMES:
+            setattr(self, name, globals()[name])
+        for name, value in configs.items():
+            if name not in CONFIG_NAMES:
+                raise TypeError(f'Unknown simulation config: {name}')
+            setattr(self, name, value)
+
+        if 'NUM_TOTAL_TOKENS' not in configs:
+            self.NUM_TOTAL_TOKENS = self.NUM_START_CLIENTS * self.NUM_TOKENS_PER_CLIENT
+        if 'CLIENT_NONE_RATE' not in configs:
+            self.CLIENT_NONE_RATE = 1 - self.CLIENT_PAY_RATE - self.CLIENT_GET_RATE
+
+        # Logs
+        self.READ_FROM_LOG = self.LOG_RUN
+        self.WRITE_TO_LOG = 1 - self.READ_FROM_LOG
+        self.action_log = action_log # list of actions tuple : (agent_id, step, action)
+        if self.action_log is None:
+            self.action_log = ActionLogWriter(self.ACTION_LOG_FILE) if self.ACTION_LOG_FILE is not None and self.WRITE_TO_LOG else []
+        # When reading from the log, actions are replayed from an index of it
+        self.replay = ActionLogReplay(self.action_log) if self.READ_FROM_LOG else None
+
+        # Randomness of the agents
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # Events of the simulation, stamped with the current step
+        self.tracer = tracer if tracer is not None else Tracer(self.TRACE_LEVEL, [ConsoleSink()])
+        self.tracer.clock = lambda: self.step_counter
+
+        # Set by the Simulator, see id_provider.py
+        self.id_provider = None
+
+        # Ongoing State
+        self.agents = {}
+        self.servers = {}
+        self.server_transforming_flag = 0 # We allow only one server to transform at a time
+        self.clients = {}
+        self.client_transforming_flag = 0 # We allow only one client to transform at a time
+        self.amount_transforming_into_clients = 0
+        self.faulty_counter = 0
+        self.step_counter = 0
+
+        # Helper state for calculating linearizability of PAY actions: [start step, answers] per PAY in progress
+        self.ongoing_pay_actions = {}
+        self.ongoing_pay_ops = {}
+
+    def id_name(self, id):
+        # The name an agent or token id is reported by
+        return self.id_provider.name(id) if self.id_provider is not None else id
+
+    def has_actions_to_replay(self):
+        return self.READ_FROM_LOG and len(self.replay) > 0
+
+    def get_agents_amount(self):
+        return len(self.agents.values())
+    def get_servers_amount(self):
+        return len(self.servers.values())
+    def get_clients_amount(self):
+        return len(self.clients.values())
+
+    def get_n_minus_t_amount(self):
+        n = self.get_servers_amount()
+        f = n // 2
+        return n-f
+
+    def get_t_plus_one(self):
+        n = self.get_servers_amount()
+        f = n // 2
+        return f+1
+
+    def get_agent_role_by_id(self, id):
+        if id in self.servers:
+            return interfaces.AgentRole.SERVER
+        else:
+            return interfaces.AgentRole.CLIENT
+
+    def get_random_server(self):
+        # Choose a random server from the servers list
+        return self.rng.choice(list(self.servers.values()))
+    def get_random_client(self):
+        # Choose a random client from the clients list
+        return self.rng.choice(list(self.clients.values()))
+    def get_random_agent(self):
+        # Choose a random agent from the agents list
+        return self.rng.choice(list(self.agents.values()))
+
+    def get_all_servers(self):
+        return self.servers.values()
+    def get_all_clients(self):
+        return self.clients.values()
+    def get_all_agents(self):
+        return self.agents.values()
+
+    def can_add_server(self):
+        return len(self.servers.values()) - self.server_transforming_flag + self.client_transforming_flag < self.MAX_SERVERS
+    def can_remove_server(self):
+        return len(self.servers.values()) - self.server_transforming_flag + self.client_transforming_flag > self.MIN_SERVERS
+    def can_add_faulty_server(self):
+        return (self.faulty_counter + 1) < len(self.servers.values()) / 2
+
+    def update_lists(self, changed_agent):
+        if changed_agent.role == interfaces.AgentRole.CLIENT:
+            self.clients.pop(changed_agent.id)
+            self.servers[changed_agent.id] = changed_agent
+        elif changed_agent.role == interfaces.AgentRole.SERVER:
+            self.servers.pop(changed_agent.id)
+            self.clients[changed_agent.id] = changed_agent
+
+    # Helper functions for calculating linearizability of PAY actions.
+    # Every PAY in progress is known by (agent_id, op_id), and found from the answers by (agent_id, pay_key)
+    # (see Agent.get_pay_key), so with pipelining the answers of a PAY never count for another PAY of the client
+    def mark_pay_start(self, agent_id, op_id, pay_key, step):
+        self.ongoing_pay_actions[(agent_id, op_id)] = [step, 0]
+        self.ongoing_pay_ops[(agent_id, pay_key)] = op_id
+
+    def mark_pay_answer(self, agent_id, pay_key, step):
+        # If the pay is not in the ongoing pay actions (e.g. an old message), ignore the message
+        op_id = self.ongoing_pay_ops.get((agent_id, pay_key))
+        if op_id is None:
+            return
+
+        ongoing = self.ongoing_pay_actions[(agent_id, op_id)]
+        ongoing[1] += 1
+
+        # Check if enough servers answered - meaning this is the linearization point
+        if ongoing[1] == self.get_n_minus_t_amount():
+            self.ongoing_pay_actions.pop((agent_id, op_id))
+            self.ongoing_pay_ops.pop((agent_id, pay_key))
+
+            # Log the linearization point
+            self.agents[agent_id].log_action(interfaces.ActionType.PAY_LINEARIZATION)
+
+    def mark_pay_finish(self, agent_id, op_id, pay_key):
+        # A quorum acknowledged the pay, so it is no longer ongoing. The linearization point was marked by then, unless
+        # the servers run in other processes (see cluster.py) and their answers are never counted here
+        self.ongoing_pay_actions.pop((agent_id, op_id), None)
+        self.ongoing_pay_ops.pop((agent_id, pay_key), None)
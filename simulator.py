@@ -1,142 +1,214 @@
-import copy
+import heapq
 import random
-from typing import List
+from typing import List, Tuple
 
-import simulation_state
+from simulation_state import SimulationContext
 from interfaces import AgentRole, Message, Token
 
 from agent import Agent
+from id_provider import make_id_provider
+from token_store import TokenStore, index_by_owner
+from schedulers import Scheduler, make_scheduler
+from timers import HierarchicalTimerWheel
 
 class Simulator:
 
-    def __init__(self):
+    def __init__(self, ctx: SimulationContext = None, scheduler: Scheduler = None):
+        # The simulator owns the whole state of the simulation
+        self.ctx = ctx if ctx is not None else SimulationContext()
         self.tokens = {}
-        simulation_state.agents = {}
-        self.msgs_queue = []
+
+        # Seeded from the simulation so that the delivery interleavings can be reproduced
+        self.rng = random.Random(self.ctx.rng.getrandbits(64))
+        # The scheduler holds the pending messages and decides the delivery order (the SCHEDULER config, if not given)
+        self.msgs_queue = scheduler if scheduler is not None else make_scheduler(self.ctx.SCHEDULER, self.rng)
 
         self.load_ids()
         self.init_agents()
         self.generate_tokens()
         self.allocate_tokens()
 
-        print('!!AGENTS!!')
-        for agent_id in simulation_state.agents:
-            print(agent_id)
-        print('!!TOKENS!!')
-        for token in self.tokens.values():
-            print(token.id + ' :: ' + str(token.owner))
-
-        for agent in simulation_state.get_all_agents():
-            agent.set_tokens_db(copy.deepcopy(self.tokens))
+        if self.ctx.tracer.debug:
+            self.ctx.tracer.emit('agents', agents=list(self.ctx.agents))
+            self.ctx.tracer.emit('tokens', tokens=[(token.id, token.owner) for token in self.tokens.values()])
+
+        # All the agents share the starting tokens and their owner index, and every agent keeps only its own changes
+        # on top of them
+        tokens_by_owner = index_by_owner(self.tokens.values())
+        for agent in self.ctx.get_all_agents():
+            agent.set_tokens_db(TokenStore(self.tokens, tokens_by_owner))
+
+        # Agents are stepped in a fixed order, and known by their index in it
+        self.ordered_agents = list(self.ctx.get_all_agents())
+        self.agent_order = {agent.id: i for i, agent in enumerate(self.ordered_agents)}
+        # Only the agents that can do something are stepped: the agents that got messages, the idle agents (that have
+        # room for another action) when they can start one, and the agents whose action times out (on the timer wheel)
+        self.idle_agents = set(range(len(self.ordered_agents)))
+        self.timers = HierarchicalTimerWheel()
+        self.timer_steps = {}
 
     def load_ids(self):
-        with open('ids.txt', 'r') as f:
-            simulation_state.IDS = f.read().strip().split('\n')
+        # Ids are made (or read from the ids file) only when an agent or token needs one
+        self.ctx.id_provider = make_id_provider(self.ctx.ID_MODE, self.ctx.seed, self.ctx.IDS_FILE)
+        self.ctx.tracer.names = self.ctx.id_provider.name if self.ctx.id_provider.names_ids else None
 
     def generate_tokens(self):
         self.tokens = {}
-        for _ in range(simulation_state.NUM_TOTAL_TOKENS):
-            t = Token()
+        for _ in range(self.ctx.NUM_TOTAL_TOKENS):
+            t = Token(self.ctx.id_provider.next_id())
             self.tokens[t.id] = t
 
     def init_agents(self):
-        simulation_state.agents = {}
-        simulation_state.servers = {}
-        simulation_state.clients = {}
+        self.ctx.agents = {}
+        self.ctx.servers = {}
+        self.ctx.clients = {}
 
-        for i in range(simulation_state.NUM_START_CLIENTS + simulation_state.NUM_START_SERVERS):
-            if i >= simulation_state.NUM_START_CLIENTS:
+        for i in range(self.ctx.NUM_START_CLIENTS + self.ctx.NUM_START_SERVERS):
+            if i >= self.ctx.NUM_START_CLIENTS:
                 # Create SERVER
                 agent_role = AgentRole.SERVER
-                agent = Agent(agent_role)
-                simulation_state.servers[agent.id] = agent
+                agent = Agent(self.ctx, agent_role)
+                self.ctx.servers[agent.id] = agent
                 # Make some servers faulty
-                if simulation_state.ALLOW_FAULTY and simulation_state.faulty_counter < simulation_state.NUM_START_SERVERS / 2:
-                    agent.set_omission_rate(simulation_state.SERVER_OMISSION_RATE)
+                if self.ctx.ALLOW_FAULTY and self.ctx.faulty_counter < self.ctx.NUM_START_SERVERS / 2:
+                    agent.set_omission_rate(self.ctx.SERVER_OMISSION_RATE)
                     agent.is_faulty = True
-                    simulation_state.faulty_counter += 1
+                    self.ctx.faulty_counter += 1
             else:
                 # Create CLIENT
                 agent_role = AgentRole.CLIENT
-                agent = Agent(agent_role)
-                simulation_state.clients[agent.id] = agent
+                agent = Agent(self.ctx, agent_role)
+                self.ctx.clients[agent.id] = agent
 
-            simulation_state.agents[agent.id] = agent
+            self.ctx.agents[agent.id] = agent
 
     def allocate_tokens(self):
-        # Create a copy of the tokens list
-        token_list_copy = copy.copy(list(self.tokens.values()))
-        for i, client in enumerate(simulation_state.get_all_clients()):
+        # Happens before the tokens are shared with the agents, so they can still be replaced
+        token_list = list(self.tokens.values())
+        for i, client in enumerate(self.ctx.get_all_clients()):
             # Randomly select X unique tokens for the client
-            tokens_to_assign = token_list_copy[i*simulation_state.NUM_TOKENS_PER_CLIENT:(i+1)*simulation_state.NUM_TOKENS_PER_CLIENT]
+            tokens_to_assign = token_list[i*self.ctx.NUM_TOKENS_PER_CLIENT:(i+1)*self.ctx.NUM_TOKENS_PER_CLIENT]
 
-            # Assign them to the client, removing from the list
+            # Assign them to the client
             for token in tokens_to_assign:
-                token.owner = client.id
+                self.tokens[token.id] = Token(token.id, token.version, client.id)
 
     def step(self):
         # Randomly delay some of the messages to the next step
         to_deliver = self.choose_and_delay_messages()
+        inboxes = self.group_by_receiver(to_deliver)
+
+        # The agents that can do something in this step
+        to_step = [self.agent_order[receiver_id] for receiver_id in inboxes]
+        to_step += self.due_agents()
+        to_step += self.initiating_agents()
+        self.step_agents(to_step, inboxes)
+
+    @staticmethod
+    def group_by_receiver(to_deliver):
+        # Group the deliveries per receiver (keeping their order), so every agent handles its messages in one call
+        inboxes = {}
+        for receiver_id, msg in to_deliver:
+            inboxes.setdefault(receiver_id, []).append(msg)
+        return inboxes
+
+    def step_agents(self, to_step, inboxes, acting=None):
+        # Step the given agents (by index) in the agents order. Only the agents in acting (all if None) may also
+        # start or repeat an action
+        heapq.heapify(to_step)
+
+        stepped = set()
+        while to_step:
+            i = heapq.heappop(to_step)
+            if i in stepped:
+                continue
+            stepped.add(i)
+
+            # The agent handles its messages then maybe generates an action
+            agent = self.ordered_agents[i]
+            for msg_out in agent.step_batch(inboxes.get(agent.id, []), acting is None or i in acting):
+                self.add_msg_to_queue(msg_out)
+            self.update_agent_state(i, agent)
+
+            # The next action of the log may belong to an agent further in the order, which still gets it in this step
+            if self.ctx.READ_FROM_LOG and acting is None:
+                next_i = self.next_replay_agent()
+                if next_i is not None and next_i > i and next_i not in stepped:
+                    heapq.heappush(to_step, next_i)
+
+    def due_agents(self):
+        # Agents whose action timed out. Timers of actions that finished or were repeated since are skipped
+        step = self.ctx.step_counter
+        due = []
+        for i in self.timers.pop_due(step):
+            timeout_step = self.ordered_agents[i].timeout_step()
+            if timeout_step is not None and timeout_step <= step:
+                due.append(i)
+        return due
+
+    def initiating_agents(self):
+        # Idle agents that may start an action in this step
+        if self.ctx.READ_FROM_LOG:
+            # Only the agent of the next action of the log
+            next_i = self.next_replay_agent()
+            return [next_i] if next_i is not None else []
+
+        clients_can = self.ctx.CLIENT_PAY_RATE > 0 or self.ctx.CLIENT_GET_RATE > 0 or self.ctx.CLIENT_TRANSFORM_RATE > 0
+        servers_can = self.ctx.SERVER_TRANSFORM_RATE > 0
+        if not clients_can and not servers_can:
+            return []
+        return [i for i in self.idle_agents
+                if (clients_can if self.ordered_agents[i].role == AgentRole.CLIENT else servers_can)]
+
+    def next_replay_agent(self):
+        next_action = self.ctx.replay.peek()
+        return self.agent_order.get(next_action[0]) if next_action is not None else None
+
+    def update_agent_state(self, i, agent: Agent):
+        # Only the agent itself changes its action state, so it is updated after every step of the agent
+        if agent.can_start_action():
+            self.idle_agents.add(i)
+        else:
+            self.idle_agents.discard(i)
 
-        for msg in to_deliver:
-            receiver_agent = simulation_state.agents[msg.receiver_id]
-
-            print(f'===>RECEIVED<=== :: {msg.type} :: {simulation_state.get_agent_role_by_id(msg.sender_id)} [...{str(msg.sender_id)[-4:]}] --> {receiver_agent.role} [...{str(receiver_agent.id)[-4:]}]')
-            response_msg = receiver_agent.step(msg)
-            if response_msg is not None:
-                print(f'<=====SENT=====> :: {response_msg.type} :: {receiver_agent.role} [...{str(receiver_agent.id)[-4:]}] --> {simulation_state.get_agent_role_by_id(response_msg.receiver_id)} [...{str(response_msg.receiver_id)[-4:]}]')
-                self.add_msg_to_queue(response_msg)
-
-        # No matter the messages, empty step all agents to generate actions
-        for agent in simulation_state.get_all_agents():
-            action_msg = agent.step(None)
-            if action_msg is not None:
-                print(f'<=====SENT=====> :: {action_msg.type} :: {agent.role} [...{str(agent.id)[-4:]}] --> [...{str(action_msg.receiver_id)[-4:]}]')
-                self.add_msg_to_queue(action_msg)
+        timeout_step = agent.timeout_step()
+        if timeout_step is not None and self.timer_steps.get(i) != timeout_step:
+            self.timers.add(timeout_step, i)
+            self.timer_steps[i] = timeout_step
 
-    # Adds the msg into the sending queue.
-    # If the message is broadcast then we duplicate it for every server
+    # Adds the msg into the sending queue, as a (receiver_id, msg) delivery.
+    # If the message is broadcast (or multicast to a tuple of ids) then it is queued for every receiver, all sharing the same message
     def add_msg_to_queue(self, msg):
         if msg.receiver_id == Message.BROADCAST_ALL:
-            # Duplicate the message to all agents
-            for agent in simulation_state.get_all_agents():
-                duplicated_msg = copy.copy(msg)
-                duplicated_msg.receiver_id = agent.id
-                self.msgs_queue.append(duplicated_msg)
+            receiver_ids = self.ctx.agents.keys()
         elif msg.receiver_id == Message.BROADCAST_SERVER:
-            # Duplicate the message to all servers
-            for server in simulation_state.get_all_servers():
-                duplicated_msg = copy.copy(msg)
-                duplicated_msg.receiver_id = server.id
-                self.msgs_queue.append(duplicated_msg)
+            receiver_ids = self.ctx.servers.keys()
         elif msg.receiver_id == Message.BROADCAST_CLIENT:
-            # Duplicate the message to all clients
-            for client in simulation_state.get_all_clients():
-                duplicated_msg = copy.copy(msg)
-                duplicated_msg.receiver_id = client.id
-                self.msgs_queue.append(duplicated_msg)
+            receiver_ids = self.ctx.clients.keys()
+        elif isinstance(msg.receiver_id, tuple):
+            # Multicast to the given agents
+            receiver_ids = msg.receiver_id
         else:
-            self.msgs_queue.append(msg)
-
+            receiver_ids = (msg.receiver_id,)
 
-    # Delays messages and returns ones to be sent in the current step
-    def choose_and_delay_messages(self) -> List[Message]:
-        to_deliver = []
+        for receiver_id in receiver_ids:
+            self.msgs_queue.add(receiver_id, msg)
 
-        # Randomly shuffle the queue
-        random.shuffle(self.msgs_queue)
 
-        # Randomly select which messages to send in this step
-        for msg in self.msgs_queue:
-            if len(to_deliver) < simulation_state.MAX_MESSAGES_PER_STEP:
-                self.msgs_queue.remove(msg)
-                to_deliver.append(msg)
+    # Delays messages and returns (receiver_id, msg) deliveries to be made in the current step
+    def choose_and_delay_messages(self) -> List[Tuple[str, Message]]:
+        # Let the scheduler select which messages to send in this step, the rest stay in the queue
+        return self.msgs_queue.choose(self.ctx.MAX_MESSAGES_PER_STEP)
 
-        return to_deliver
+    def has_pending_work(self):
+        # Something can still happen: messages are in flight, actions in progress wait on their timers (to be
+        # repeated if their answers were lost), or actions are left to replay.
+        # Timers of actions that finished since stay until they are due, which only runs a little longer
+        return len(self.msgs_queue) > 0 or len(self.timers) > 0 or self.ctx.has_actions_to_replay()
 
     def close(self):
-        simulation_state.CLIENT_PAY_RATE = 0
-        simulation_state.CLIENT_GET_RATE = 0
-        simulation_state.CLIENT_NONE_RATE = 1
-        simulation_state.CLIENT_TRANSFORM_RATE = 0
-        simulation_state.SERVER_TRANSFORM_RATE = 0
+        self.ctx.CLIENT_PAY_RATE = 0
+        self.ctx.CLIENT_GET_RATE = 0
+        self.ctx.CLIENT_NONE_RATE = 1
+        self.ctx.CLIENT_TRANSFORM_RATE = 0
+        self.ctx.SERVER_TRANSFORM_RATE = 0
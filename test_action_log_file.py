@@ -0,0 +1,69 @@
+import pytest
+
+from action_log_file import FILE_HEADER, RECORD_HEADER, ActionLogFile, ActionLogWriter, write_action_log
+from interfaces import ActionType, Message, MessageType
+
+CLIENT = '7e4fdccd-549a-4933-b7b6-b0d2a856a935'
+TOKEN = 'fe4d3803-adae-4a30-952a-a6c380115c5b'
+
+ENTRIES = [
+    (CLIENT, 3, ActionType.PAY_START, Message(MessageType.PAY, CLIENT, Message.BROADCAST_SERVER, (TOKEN, 12, 1))),
+    (CLIENT, 4.25, ActionType.PAY_LINEARIZATION, None),
+    (12, 7, ActionType.GET_TOKENS_START, Message(MessageType.GET_TOKENS, 12, Message.BROADCAST_SERVER, (0, {}, 2))),
+    (CLIENT, 9, ActionType.PAY_FINISH, None),
+]
+
+
+def plain(entry):
+    agent_id, step, action_type, action_msg = entry
+    msg = (action_msg.type, action_msg.sender_id, action_msg.receiver_id, action_msg.content) if action_msg is not None else None
+    return agent_id, step, type(step), action_type, msg
+
+def write(path, entries, checkpoint_every=2):
+    write_action_log(str(path), entries, checkpoint_every)
+    return str(path)
+
+
+def test_round_trip(tmp_path):
+    with ActionLogFile(write(tmp_path / 'log.bin', ENTRIES)) as log:
+        assert len(log) == len(ENTRIES)
+        assert [plain(entry) for entry in log] == [plain(entry) for entry in ENTRIES]
+        assert plain(log[-1]) == plain(ENTRIES[-1])
+        assert list(log.action_keys()) == [(agent_id, action_type) for agent_id, _, action_type, _ in ENTRIES]
+
+def test_writer_reads_back_what_was_written(tmp_path):
+    writer = ActionLogWriter(str(tmp_path / 'log.bin'), checkpoint_every=3)
+    for entry in ENTRIES[:2]:
+        writer.append(entry)
+    assert [plain(entry) for entry in writer] == [plain(entry) for entry in ENTRIES[:2]]
+    writer.close()
+
+def test_truncated_trailing_record_is_ignored(tmp_path):
+    # A writer that crashed while writing its last action, after its last checkpoint
+    path = str(tmp_path / 'log.bin')
+    writer = ActionLogWriter(path, checkpoint_every=len(ENTRIES) - 1)
+    for entry in ENTRIES:
+        writer.append(entry)
+    writer.file.close()
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 3)
+    with ActionLogFile(path) as log:
+        assert len(log) == len(ENTRIES) - 1
+        assert [plain(entry) for entry in log] == [plain(entry) for entry in ENTRIES[:-1]]
+
+def test_bad_checkpoint(tmp_path):
+    path = write(tmp_path / 'log.bin', ENTRIES)
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        # Flip a byte of the first action, covered by the first checkpoint
+        data[FILE_HEADER.size + RECORD_HEADER.size] ^= 0xff
+        f.seek(0)
+        f.write(data)
+    with pytest.raises(ValueError, match='checkpoint'):
+        ActionLogFile(path)
+
+def test_not_an_action_log(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'NOPE\x01')
+    with pytest.raises(ValueError):
+        ActionLogFile(str(path))
@@ -0,0 +1,80 @@
+from action_log_file import ActionLogFile, write_action_log
+from action_replay import ActionLogReplay
+from interfaces import ActionType
+
+S, F = ActionType.PAY_START, ActionType.PAY_FINISH
+G, GF = ActionType.GET_TOKENS_START, ActionType.GET_TOKENS_FINISH
+
+# Integer agent ids, so the log can also be written to a file
+A, B = 1, 2
+
+LOG = [
+    (A, 1, S, None),
+    (B, 2, G, None),
+    (A, 3, F, None),
+    (B, 4, GF, None),
+    (A, 5, S, None),
+    (A, 6, F, None),
+]
+
+
+def steps(entries):
+    return [step for _, step, _, _ in entries]
+
+
+def test_pop_next_follows_the_log():
+    replay = ActionLogReplay(LOG)
+    assert steps(replay.pop_next() for _ in LOG) == [1, 2, 3, 4, 5, 6]
+    assert replay.pop_next() is None
+    assert replay.peek() is None
+    assert len(replay) == 0
+
+def test_pop_first_matches_the_oldest_of_the_agent_and_type():
+    replay = ActionLogReplay(LOG)
+    assert replay.pop_first(A, F)[1] == 3
+    assert replay.pop_first(A, F)[1] == 6
+    assert replay.pop_first(A, F) is None
+    assert replay.pop_first(B, F) is None
+    assert replay.progress()['matched'] == 2
+
+def test_peek_skips_what_was_consumed_out_of_order():
+    replay = ActionLogReplay(LOG)
+    assert replay.peek()[1] == 1
+
+    # The finish of b is consumed before the actions ahead of it
+    replay.pop_first(B, GF)
+    assert replay.pop_next()[1] == 1
+    assert replay.pop_next()[1] == 2
+    assert replay.pop_next()[1] == 3
+    # Its position is skipped by the cursor
+    assert replay.peek()[1] == 5
+
+    # Consuming the entry at the cursor moves the peek on
+    replay.pop_first(A, S)
+    assert replay.peek()[1] == 6
+    assert steps(replay.remaining_entries()) == [6]
+
+def test_queues_stay_in_step_with_the_cursor():
+    replay = ActionLogReplay(LOG)
+    # Taken by pop_next, so the queue of (a, PAY_START) gives the next start of a
+    assert replay.pop_next()[1] == 1
+    assert replay.pop_first(A, S)[1] == 5
+    assert replay.pop_first(A, S) is None
+
+    # And taken by pop_first, the cursor doesn't give it again
+    assert replay.pop_first(B, G)[1] == 2
+    assert replay.pop_next()[1] == 3
+    assert steps(replay.remaining_entries()) == [4, 6]
+    assert len(replay) == 2
+
+    progress = replay.progress()
+    assert (progress['replayed'], progress['remaining'], progress['started']) == (4, 2, 1)
+
+def test_replay_from_a_log_file(tmp_path):
+    path = str(tmp_path / 'log.bin')
+    write_action_log(path, LOG, 2)
+    with ActionLogFile(path) as log:
+        replay = ActionLogReplay(log)
+        assert replay.pop_first(B, GF)[1] == 4
+        assert steps(replay.pop_next() for _ in range(5)) == [1, 2, 3, 5, 6]
+        assert len(replay) == 0
@@ -0,0 +1,69 @@
+from interfaces import ActionType, Message, MessageType
+from simulation_state import SimulationContext
+from simulator import Simulator
+from tracing import TraceLevel
+
+
+def make_client(**configs):
+    ctx = SimulationContext(0, ALLOW_FAULTY=False, TRACE_LEVEL=TraceLevel.OFF, **configs)
+    Simulator(ctx)
+    ctx.step_counter = 1
+    return ctx, next(iter(ctx.clients.values()))
+
+def run_get(ctx, client):
+    # A GET of the client, answered by every server. Returns what the client sent, None if it answered it locally
+    msg = client.run_get_request()
+    if msg is None:
+        return None
+    for server in ctx.servers.values():
+        answer = server.handle_incoming(Message(msg.type, msg.sender_id, server.id, msg.content))
+        client.handle_incoming(answer)
+    return msg
+
+def gets_logged(ctx, client):
+    return [action_type for agent_id, _, action_type, _ in ctx.action_log
+            if agent_id == client.id and action_type in (ActionType.GET_TOKENS_START, ActionType.GET_TOKENS_FINISH)]
+
+
+def test_get_without_max_age_always_asks_the_servers():
+    ctx, client = make_client()
+    assert run_get(ctx, client).type == MessageType.GET_TOKENS
+    assert client.refreshed_step == 1
+
+    ctx.step_counter = 2
+    assert run_get(ctx, client) is not None
+
+def test_fresh_get_is_answered_locally():
+    ctx, client = make_client(CLIENT_CACHE_MAX_AGE=10)
+    # Never refreshed yet, so the first GET goes to the servers
+    assert run_get(ctx, client) is not None
+    assert not client.during_action
+
+    # Within the max age, the GET round is skipped. It is still logged, so a replay runs the same GET
+    ctx.step_counter = 11
+    assert run_get(ctx, client) is None
+    assert not client.during_action
+    assert client.refreshed_step == 1
+    assert gets_logged(ctx, client) == [ActionType.GET_TOKENS_START, ActionType.GET_TOKENS_FINISH] * 2
+
+def test_stale_get_refreshes_from_the_servers():
+    ctx, client = make_client(CLIENT_CACHE_MAX_AGE=10)
+    run_get(ctx, client)
+
+    # Past the max age, the GET goes to the servers again and their answers refresh the DB
+    ctx.step_counter = 12
+    msg = run_get(ctx, client)
+    assert msg is not None and msg.type == MessageType.GET_TOKENS
+    assert client.refreshed_step == 12
+
+    # Fresh again from the new refresh
+    ctx.step_counter = 22
+    assert run_get(ctx, client) is None
+
+def test_get_round_of_a_pay_is_not_answered_locally():
+    ctx, client = make_client(CLIENT_CACHE_MAX_AGE=10)
+    run_get(ctx, client)
+
+    ctx.step_counter = 2
+    msg = client.run_get_request(part_of_pay_request=True)
+    assert msg is not None and msg.type == MessageType.GET_TOKENS
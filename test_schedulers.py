@@ -0,0 +1,29 @@
+import pytest
+
+import main
+from schedulers import SCHEDULERS, make_scheduler
+from simulation_state import SimulationContext
+from tracing import TraceLevel
+
+
+def run(seed, scheduler):
+    # The actions and the final DB of one run with omissions, in a comparable form
+    ctx = SimulationContext(seed, **dict(main.OMISSIONS_RUN_CONFIGS, SCHEDULER=scheduler, STEPS_UNTIL_CLOSE=100,
+                                         TRACE_LEVEL=TraceLevel.OFF))
+    final_db = main.run_simulation_test(ctx)
+    actions = [(agent_id, step, action_type, None if msg is None else (msg.type, msg.sender_id, msg.receiver_id))
+               for agent_id, step, action_type, msg in ctx.action_log]
+    return actions, {token.id: (token.version, token.owner) for token in final_db.values()}
+
+
+@pytest.mark.parametrize('scheduler', sorted(SCHEDULERS))
+def test_scheduler_replays_the_same_run_for_a_seed(scheduler):
+    first_actions, first_db = run(3, scheduler)
+    second_actions, second_db = run(3, scheduler)
+    assert first_actions
+    assert first_actions == second_actions
+    assert first_db == second_db
+
+def test_unknown_scheduler():
+    with pytest.raises(ValueError):
+        make_scheduler('lifo')
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+from timers import BACKOFFS, HierarchicalTimerWheel, exponential_backoff, fixed_backoff, jittered_backoff
+
+
+class SortedTimers:
+    # Reference: every timer in one list sorted by due step
+
+    def __init__(self):
+        self.timers = []
+        self.now = 0
+
+    def __len__(self):
+        return len(self.timers)
+
+    def add(self, due_step, key):
+        self.timers.append((max(due_step, self.now), key))
+        self.timers.sort(key=lambda timer: timer[0])
+
+    def pop_due(self, step):
+        self.now = max(self.now, step)
+        due = [timer for timer in self.timers if timer[0] <= step]
+        self.timers = self.timers[len(due):]
+        return {key for _, key in due}
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_wheel_matches_sorted_timers(seed):
+    rng = random.Random(seed)
+    # A small wheel, so timers go through every level, cascade down and overflow
+    wheel = HierarchicalTimerWheel(slots_per_level=4, levels=3)
+    reference = SortedTimers()
+
+    step = 0
+    for _ in range(300):
+        for _ in range(rng.randint(0, 3)):
+            # Some timers are already due (or in the past), some are far beyond the last level
+            due_step = step + rng.choice([-2, 0, 1, rng.randint(1, 10), rng.randint(10, 70), rng.randint(60, 300)])
+            key = rng.randint(0, 15)
+            wheel.add(due_step, key)
+            reference.add(due_step, key)
+
+        step += rng.choice([1, 1, 1, 2, 5, 17])
+        assert wheel.pop_due(step) == reference.pop_due(step)
+        assert len(wheel) == len(reference)
+
+    # Everything left fires once its step is reached
+    step += 400
+    assert wheel.pop_due(step) == reference.pop_due(step)
+    assert len(wheel) == 0
+
+def test_timer_fires_at_its_step_only():
+    wheel = HierarchicalTimerWheel(slots_per_level=4, levels=2)
+    wheel.add(37, 'a')
+    assert wheel.pop_due(36) == set()
+    assert wheel.pop_due(37) == {'a'}
+    assert wheel.pop_due(100) == set()
+
+def test_key_with_several_timers_is_given_once():
+    wheel = HierarchicalTimerWheel()
+    wheel.add(5, 'a')
+    wheel.add(5, 'a')
+    wheel.add(3, 'a')
+    assert wheel.pop_due(5) == {'a'}
+    assert len(wheel) == 0
+
+def test_timer_added_when_due_fires_on_next_pop():
+    wheel = HierarchicalTimerWheel()
+    wheel.pop_due(10)
+    wheel.add(4, 'late')
+    wheel.add(10, 'now')
+    assert len(wheel) == 2
+    assert wheel.pop_due(10) == {'late', 'now'}
+
+
+def test_fixed_backoff():
+    rng = random.Random(0)
+    assert [fixed_backoff(30, 240, attempt, rng) for attempt in range(5)] == [30, 30, 30, 30, 30]
+
+def test_exponential_backoff_is_capped():
+    rng = random.Random(0)
+    assert [exponential_backoff(30, 240, attempt, rng) for attempt in range(6)] == [30, 60, 120, 240, 240, 240]
+
+def test_jittered_backoff_is_within_half_of_exponential():
+    rng = random.Random(0)
+    for attempt in range(8):
+        backoffs = {jittered_backoff(30, 240, attempt, rng) for _ in range(200)}
+        exponential = exponential_backoff(30, 240, attempt, rng)
+        assert min(backoffs) >= exponential // 2
+        assert max(backoffs) <= exponential
+        # It does spread the retries out
+        assert len(backoffs) > 1
+
+def test_jittered_backoff_is_seeded():
+    first = [jittered_backoff(30, 240, attempt, random.Random(7)) for attempt in range(6)]
+    second = [jittered_backoff(30, 240, attempt, random.Random(7)) for attempt in range(6)]
+    assert first == second
+
+def test_backoffs_by_name():
+    assert BACKOFFS == {'fixed': fixed_backoff, 'exponential': exponential_backoff, 'jittered': jittered_backoff}
@@ -0,0 +1,69 @@
+from interfaces import Token
+from token_store import TokenStore, index_by_owner
+
+
+def make_store():
+    base = {token.id: token for token in [Token('a', 0, 'alice'), Token('b', 0, 'alice'), Token('c', 0, 'bob')]}
+    return base, TokenStore(base, index_by_owner(base.values()))
+
+def ids(tokens):
+    return sorted(token.id for token in tokens)
+
+
+def test_tokens_of_the_base():
+    _, store = make_store()
+    assert ids(store.tokens_of('alice')) == ['a', 'b']
+    assert ids(store.tokens_of('bob')) == ['c']
+    assert store.tokens_of('carol') == []
+
+def test_change_moves_the_token_to_its_new_owner():
+    _, store = make_store()
+    store.set(Token('a', 1, 'bob'))
+    assert ids(store.tokens_of('alice')) == ['b']
+    assert ids(store.tokens_of('bob')) == ['a', 'c']
+
+    # Moved again, it leaves the owner of the previous change too
+    store.set(Token('a', 2, 'carol'))
+    assert ids(store.tokens_of('bob')) == ['c']
+    assert ids(store.tokens_of('carol')) == ['a']
+
+    # And back to its owner in the base
+    store.set(Token('a', 3, 'alice'))
+    assert ids(store.tokens_of('alice')) == ['a', 'b']
+    assert ids(store.tokens_of('carol')) == []
+
+def test_change_overrides_the_base():
+    base, store = make_store()
+    store.set(Token('c', 4, 'alice'))
+    assert store['c'].version == 4
+    assert [token.version for token in store.tokens_of('alice') if token.id == 'c'] == [4]
+    assert {token_id: token.version for token_id, token in store.items()} == {'a': 0, 'b': 0, 'c': 4}
+
+    # The shared base is never changed, so the other agents still see it
+    assert base['c'].version == 0 and base['c'].owner == 'bob'
+    other = TokenStore(base, store.base_owners)
+    assert ids(other.tokens_of('bob')) == ['c']
+
+def test_new_token_on_top_of_the_base():
+    _, store = make_store()
+    store.set(Token('d', 0, 'bob'))
+    assert len(store) == 4
+    assert 'd' in store
+    assert list(store) == ['a', 'b', 'c', 'd']
+    assert ids(store.tokens_of('bob')) == ['c', 'd']
+
+def test_changed_since_gives_the_deltas():
+    _, store = make_store()
+    assert store.changed_since(0) == []
+
+    store.set(Token('a', 1, 'bob'))
+    seen = store.seq
+    store.set(Token('b', 1, 'bob'))
+    store.set(Token('c', 1, 'alice'))
+    assert ids(store.changed_since(seen)) == ['b', 'c']
+
+    # A token changed again is given once, at its latest change
+    store.set(Token('a', 2, 'carol'))
+    assert [(token.id, token.version) for token in store.changed_since(seen)] == [('a', 2), ('c', 1), ('b', 1)]
+    assert store.changed_since(store.seq) == []
+    assert ids(store.changed_tokens()) == ['a', 'b', 'c']
@@ -0,0 +1,75 @@
+from interfaces import Message, MessageType
+from upon_registry import UponRegistry
+
+
+def ack_pay(sender_id, token_id, version):
+    return Message(MessageType.ACK_PAY, sender_id, 'client', (token_id, version))
+
+def ack_get(sender_id, op_id=None):
+    content = ([], 0) if op_id is None else ([], 0, op_id)
+    return Message(MessageType.ACK_GET_TOKENS, sender_id, 'client', content)
+
+
+def test_message_matches_only_its_type_and_key():
+    registry = UponRegistry()
+    pay_a = registry.register(None, MessageType.ACK_PAY, lambda: 2, key=('a', 1))
+    pay_b = registry.register(None, MessageType.ACK_PAY, lambda: 2, key=('b', 1))
+    get = registry.register(None, MessageType.ACK_GET_TOKENS, lambda: 2)
+    get_op = registry.register(None, MessageType.ACK_GET_TOKENS, lambda: 2, key=7)
+
+    assert registry.match(ack_pay('s1', 'a', 1)) == [pay_a]
+    assert registry.match(ack_pay('s1', 'b', 1)) == [pay_b]
+    # An older version of the token is another key
+    assert registry.match(ack_pay('s1', 'a', 0)) == []
+    assert registry.match(ack_get('s1')) == [get]
+    assert registry.match(ack_get('s1', 7)) == [get_op]
+    assert registry.match(Message(MessageType.ACK_DB_UPDATE, 's1', 's2', ())) == []
+
+def test_batched_ack_pay_key():
+    registry = UponRegistry()
+    upon = registry.register(None, MessageType.ACK_PAY, lambda: 1, key=(('a', 1), ('b', 2)))
+    msg = Message(MessageType.ACK_PAY, 's1', 'client', [('a', 1), ('b', 2)])
+    assert registry.receive(msg) is upon
+
+def test_upon_is_removed_once_ready():
+    registry = UponRegistry()
+    upon = registry.register(None, MessageType.ACK_PAY, lambda: 2, key=('a', 1))
+
+    assert registry.receive(ack_pay('s1', 'a', 1)) is None
+    assert len(registry) == 1
+    assert registry.receive(ack_pay('s2', 'a', 1)) is upon
+    assert upon.senders == {'s1', 's2'}
+    assert len(registry) == 0
+    assert registry.index == {}
+
+    # Late answers find nothing to match
+    assert registry.receive(ack_pay('s3', 'a', 1)) is None
+    assert registry.match(ack_pay('s3', 'a', 1)) == []
+
+def test_first_ready_upon_is_given_first():
+    registry = UponRegistry()
+    first = registry.register(None, MessageType.ACK_GET_TOKENS, lambda: 1)
+    second = registry.register(None, MessageType.ACK_GET_TOKENS, lambda: 1)
+
+    # Both get the message, the first registered is ready first
+    assert registry.receive(ack_get('s1')) is first
+    assert registry.receive(ack_get('s2')) is second
+    assert len(registry) == 0
+
+def test_pop_ready_after_the_amount_drops():
+    registry = UponRegistry()
+    amount = {'pay': 3, 'get': 3}
+    pay = registry.register(None, MessageType.ACK_PAY, lambda: amount['pay'], key=('a', 1))
+    get = registry.register(None, MessageType.ACK_GET_TOKENS, lambda: amount['get'])
+    registry.receive(ack_get('s1'))
+    registry.receive(ack_get('s2'))
+    registry.receive(ack_pay('s1', 'a', 1))
+    registry.receive(ack_pay('s2', 'a', 1))
+    assert registry.pop_ready() is None
+
+    # Fewer servers, so fewer answers are enough. Ready upons are given in registration order
+    amount['pay'] = amount['get'] = 2
+    assert registry.pop_ready() is pay
+    assert registry.pop_ready() is get
+    assert registry.pop_ready() is None
+    assert len(registry) == 0
@@ -0,0 +1,73 @@
+import pytest
+
+from interfaces import Message, MessageType, Token
+import wire_format
+
+CLIENT = '7e4fdccd-549a-4933-b7b6-b0d2a856a935'
+SERVER = 'bd3960ad-cc58-4fb6-82b5-c63034ea5a8c'
+TOKEN_A = 'fe4d3803-adae-4a30-952a-a6c380115c5b'
+TOKEN_B = 'cdca3230-8050-4d76-b7c7-28b5afbf0d10'
+
+
+def plain(value):
+    # Contents with their tokens as tuples, so they can be compared
+    if isinstance(value, Token):
+        return ('token', value.id, value.version, value.owner)
+    if isinstance(value, (list, tuple)):
+        return type(value)(plain(item) for item in value)
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    return value
+
+def round_trip(msg: Message) -> Message:
+    return wire_format.decode(wire_format.encode(msg))
+
+def assert_same(msg: Message, decoded: Message):
+    assert decoded.type == msg.type
+    assert decoded.sender_id == msg.sender_id
+    assert decoded.receiver_id == msg.receiver_id
+    assert plain(decoded.content) == plain(msg.content)
+
+
+MESSAGES = [
+    Message(MessageType.PAY, CLIENT, Message.BROADCAST_SERVER, (TOKEN_A, SERVER, 3)),
+    Message(MessageType.ACK_PAY, SERVER, CLIENT, (TOKEN_A, 3)),
+    Message(MessageType.GET_TOKENS, CLIENT, Message.BROADCAST_SERVER, (0, {SERVER: 12})),
+    Message(MessageType.GET_TOKENS, CLIENT, Message.BROADCAST_SERVER, (CLIENT, {})),
+    Message(MessageType.ACK_GET_TOKENS, SERVER, CLIENT, ([Token(TOKEN_A, 2, CLIENT), Token(TOKEN_B, 0, None)], 12)),
+    Message(MessageType.DB_UPDATE, SERVER, Message.BROADCAST_SERVER, [Token(TOKEN_B, 5, SERVER)]),
+    Message(MessageType.ACK_DB_UPDATE, SERVER, CLIENT, ()),
+    Message(MessageType.TURNED_TO_CLIENT, SERVER, Message.BROADCAST_CLIENT, ()),
+    Message(MessageType.TURNED_TO_SERVER, CLIENT, Message.BROADCAST_CLIENT, ()),
+]
+
+def test_every_message_type_is_covered():
+    assert {msg.type for msg in MESSAGES} == set(MessageType)
+
+@pytest.mark.parametrize('msg', MESSAGES, ids=lambda msg: msg.type.name)
+def test_round_trip(msg):
+    assert_same(msg, round_trip(msg))
+
+def test_round_trip_integer_ids_and_multicast():
+    msg = Message(MessageType.PAY, 10, (11, 12, 13), (20, 14, 1))
+    assert_same(msg, round_trip(msg))
+
+def test_round_trip_batched_pay():
+    pay = Message(MessageType.PAY, CLIENT, Message.BROADCAST_SERVER, [(TOKEN_A, SERVER, 3), (TOKEN_B, CLIENT, 1)])
+    ack = Message(MessageType.ACK_PAY, SERVER, CLIENT, [(TOKEN_A, 3), (TOKEN_B, 1)])
+    assert_same(pay, round_trip(pay))
+    assert_same(ack, round_trip(ack))
+    assert wire_format.encode(pay)[2] & wire_format.BATCH
+
+def test_round_trip_op_id():
+    get = Message(MessageType.GET_TOKENS, CLIENT, Message.BROADCAST_SERVER, (0, {SERVER: 4}, 7))
+    ack = Message(MessageType.ACK_GET_TOKENS, SERVER, CLIENT, ([Token(TOKEN_A, 1, CLIENT)], 4, 7))
+    assert_same(get, round_trip(get))
+    assert_same(ack, round_trip(ack))
+    assert wire_format.encode(get)[2] & wire_format.HAS_OP_ID
+
+def test_unsupported_version():
+    data = bytearray(wire_format.encode(MESSAGES[0]))
+    data[0] = wire_format.WIRE_VERSION + 1
+    with pytest.raises(ValueError):
+        wire_format.decode(bytes(data))
@@ -0,0 +1,90 @@
+class HierarchicalTimerWheel:
+    # Timers of agents in levels of wheels: level 0 has a slot per step, and every level above it has a slot per
+    # slots_per_level steps of the level below. A timer is put in the level matching how far ahead it is due, and
+    # moves down a level when the wheel reaches its slot. So adding a timer and firing it cost O(levels) no matter
+    # how far ahead it is (e.g. long exponential backoffs), and a step only looks at the timers due in it.
+
+    def __init__(self, slots_per_level=64, levels=4):
+        self.slots_per_level = slots_per_level
+        self.levels = [[[] for _ in range(slots_per_level)] for _ in range(levels)]
+        # Timers beyond the last level, and timers added when they were already due
+        self.overflow = []
+        self.expired = []
+        self.now = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, due_step, key):
+        self.count += 1
+        self.place(due_step, key)
+
+    def place(self, due_step, key):
+        if due_step <= self.now:
+            self.expired.append(key)
+            return
+
+        delta = due_step - self.now
+        span = 1
+        for level in self.levels:
+            if delta < span * self.slots_per_level:
+                level[(due_step // span) % self.slots_per_level].append((due_step, key))
+                return
+            span *= self.slots_per_level
+        self.overflow.append((due_step, key))
+
+    def pop_due(self, step):
+        # Move the wheel up to the step, and return the keys of the timers that are due. Each key is given once
+        due = set(self.expired)
+        fired = len(self.expired)
+        self.expired = []
+
+        n = self.slots_per_level
+        while self.now < step:
+            self.now += 1
+
+            # The timers of the coarser levels whose slot is reached move down, coarsest first
+            if self.now % (n ** len(self.levels)) == 0:
+                timers, self.overflow = self.overflow, []
+                for due_step, key in timers:
+                    self.place(due_step, key)
+            for k in range(len(self.levels) - 1, 0, -1):
+                span = n ** k
+                if self.now % span == 0:
+                    slot_i = (self.now // span) % n
+                    timers, self.levels[k][slot_i] = self.levels[k][slot_i], []
+                    for due_step, key in timers:
+                        self.place(due_step, key)
+
+            # Timers moved down to the current step were put in expired
+            due.update(self.expired)
+            fired += len(self.expired)
+            self.expired = []
+
+            slot_i = self.now % n
+            timers, self.levels[0][slot_i] = self.levels[0][slot_i], []
+            due.update(key for _, key in timers)
+            fired += len(timers)
+
+        self.count -= fired
+        return due
+
+
+# Backoffs: how many steps to wait before the attempt-th retry of an action (attempt 0 is the first timeout)
+def fixed_backoff(timeout, max_timeout, attempt, rng):
+    return timeout
+
+def exponential_backoff(timeout, max_timeout, attempt, rng):
+    return min(timeout * 2 ** attempt, max_timeout)
+
+def jittered_backoff(timeout, max_timeout, attempt, rng):
+    # Exponential, randomly shortened by up to half so that retries of many agents spread out
+    backoff = exponential_backoff(timeout, max_timeout, attempt, rng)
+    return rng.randint(backoff // 2, backoff)
+
+BACKOFFS = {
+    'fixed': fixed_backoff,
+    'exponential': exponential_backoff,
+    'jittered': jittered_backoff,
+}
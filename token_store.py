@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from typing import Dict, List
+
+from interfaces import Token
+
+
+class TokenStore:
+    # Copy-on-write tokens DB of one agent.
+    # All the agents share the same base {token_id: Token}, which is never changed, and every agent keeps only the
+    # tokens it changed on top of it. Tokens are never changed in place either (a change is a new Token), so tokens
+    # can be shared between agents and messages, and a new agent costs O(1) instead of a copy of the whole DB.
+    # Tokens are indexed by owner the same way: the index of the base is shared, and every agent indexes its changes.
+
+    def __init__(self, base: Dict[str, Token], base_owners: Dict[str, List[Token]] = None):
+        self.base = base
+        # The tokens of every owner in the base (see index_by_owner)
+        self.base_owners = base_owners if base_owners is not None else index_by_owner(base.values())
+        # The tokens changed on top of the base, ordered by the sequence of their last change
+        self.changes = OrderedDict()
+        self.change_seqs = {}
+        # Ids of the changed tokens by their current owner (dicts as ordered sets)
+        self.owners = {}
+        # Sequence number of the last change
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.base) + sum(1 for token_id in self.changes if token_id not in self.base)
+
+    def __contains__(self, token_id):
+        return token_id in self.changes or token_id in self.base
+
+    def __getitem__(self, token_id) -> Token:
+        token = self.changes.get(token_id)
+        return token if token is not None else self.base[token_id]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, token_id, default=None):
+        return self[token_id] if token_id in self else default
+
+    def keys(self):
+        yield from self.base
+        for token_id in self.changes:
+            if token_id not in self.base:
+                yield token_id
+
+    def values(self):
+        for token_id, token in self.items():
+            yield token
+
+    def items(self):
+        for token_id, token in self.base.items():
+            yield token_id, self.changes.get(token_id, token)
+        for token_id, token in self.changes.items():
+            if token_id not in self.base:
+                yield token_id, token
+
+    def set(self, token: Token):
+        previous = self.changes.get(token.id)
+        if previous is not None and previous.owner != token.owner:
+            del self.owners[previous.owner][token.id]
+        self.owners.setdefault(token.owner, {})[token.id] = None
+
+        # Every change gets a new sequence number
+        self.seq += 1
+        self.changes[token.id] = token
+        self.changes.move_to_end(token.id)
+        self.change_seqs[token.id] = self.seq
+
+    def tokens_of(self, owner_id) -> List[Token]:
+        # The tokens of the owner, in O(tokens of the owner)
+        changes = self.changes
+        tokens = [token for token in self.base_owners.get(owner_id, ()) if token.id not in changes]
+        tokens += [changes[token_id] for token_id in self.owners.get(owner_id, ())]
+        return tokens
+
+    def changed_since(self, seq) -> List[Token]:
+        # The tokens changed after the given sequence, latest first
+        changed = []
+        for token_id in reversed(self.changes):
+            if self.change_seqs[token_id] <= seq:
+                break
+            changed.append(self.changes[token_id])
+        return changed
+
+    def changed_tokens(self) -> List[Token]:
+        # Everything that differs from the shared base
+        return list(self.changes.values())
+
+
+def index_by_owner(tokens) -> Dict[str, List[Token]]:
+    owners = {}
+    for token in tokens:
+        owners.setdefault(token.owner, []).append(token)
+    return owners
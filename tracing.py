@@ -0,0 +1,137 @@
+from collections import deque
+from enum import Enum, IntEnum
+import json
+
+
+class TraceLevel(IntEnum):
+    OFF = 0
+    INFO = 1    # Actions, timeouts and transformations
+    DEBUG = 2   # Every message sent, received or omitted
+
+
+def short_id(id):
+    # Agents and tokens are shown by the last 4 characters of their id
+    return str(id)[-4:]
+
+
+# Human readable format of every event, as the simulation used to print them
+CONSOLE_FORMATS = {
+    'agents': lambda r: '!!AGENTS!!\n' + '\n'.join(str(agent_id) for agent_id in r['agents']),
+    'tokens': lambda r: '!!TOKENS!!\n' + '\n'.join(f'{token_id} :: {owner}' for token_id, owner in r['tokens']),
+    'step': lambda r: f'--------- Step #{r["step"] + 1} ---------',
+    'closed': lambda r: '==>==>==>==>==> CALLED CLOSED - NO MORE NEW ACTIONS <==<==<==<==<==',
+    'infinite_loop': lambda r: 'Infinite loop detected. Exiting...',
+
+    'received': lambda r: f'===>RECEIVED<=== :: {r["msg_type"]} :: {r["sender_role"]} [...{short_id(r["sender"])}] --> {r["receiver_role"]} [...{short_id(r["receiver"])}]',
+    'sent': lambda r: f'<=====SENT=====> :: {r["msg_type"]} :: {r["sender_role"]} [...{short_id(r["sender"])}] --> {r["receiver_role"]} [...{short_id(r["receiver"])}]',
+    'action_sent': lambda r: f'<=====SENT=====> :: {r["msg_type"]} :: {r["sender_role"]} [...{short_id(r["sender"])}] --> [...{short_id(r["receiver"])}]',
+    'omit_incoming': lambda r: f'>OMIT//INCOMING< :: {r["role"]} :: [...{short_id(r["agent"])}]',
+    'omit_outgoing': lambda r: f'>OMIT//OUTGOING< :: {r["role"]} :: [...{short_id(r["agent"])}]',
+
+    'action_timeout': lambda r: f'!ACTION//TIMEOUT! :: [...{short_id(r["agent"])}] :: ~REPEATING~ :: {r["msg"]}',
+    'transform_initiated': lambda r: f'!TRANSFORMATION! :: [...{short_id(r["agent"])}] :: ~INITIATED~ :: {r["from_role"].name} --> {r["to_role"].name}.',
+    'transform_done': lambda r: f'!TRANSFORMATION! :: [...{short_id(r["agent"])}] :: ~DONE~ :: {r["from_role"].name} --> {r["to_role"].name}.',
+    'pay_started': lambda r: f'~~PAY//STARTED~~ :: [...{short_id(r["agent"])}]\n'
+                             f'$$$TOKEN-SUGG$$$ :: Token ID: [...{short_id(r["token"])}] / Version: {r["version"]} :: [...{short_id(r["agent"])}] --> [...{short_id(r["buyer"])}]',
+    'pay_linearization': lambda r: f'$$$PAY_LINEAR$$$ :: Seller: [...{short_id(r["agent"])}]',
+    'pay_ended': lambda r: f'~~~PAY//ENDED~~~ :: [...{short_id(r["agent"])}]\n'
+                           f'$$$TOKEN-SOLD$$$ :: Token ID: [...{short_id(r["token"])}] / Version: {r["version"]} :: [...{short_id(r["agent"])}] --> [...{short_id(r["buyer"])}]',
+    'get_ended': lambda r: f'~~~GET//ENDED~~~ :: [...{short_id(r["agent"])}]' +
+                           (f'\n$$OWNER-TOKENS$$ :: Owner: [...{short_id(r["owner"])}] / Tokens: {len(r["tokens"])}' if 'tokens' in r else ''),
+}
+
+
+class NullSink:
+    # Drops every event
+
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class RingBufferSink:
+    # Keeps only the last `capacity` events in memory, e.g. to look at what led to a failure
+
+    def __init__(self, capacity=10000):
+        self.records = deque(maxlen=capacity)
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class JsonlFileSink:
+    # Writes every event as a JSON line
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    @staticmethod
+    def to_json(value):
+        if isinstance(value, Enum):
+            return value.name
+        return str(value)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=self.to_json) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ConsoleSink:
+    # Prints the events in a human readable format
+
+    def write(self, record):
+        print(CONSOLE_FORMATS[record['event']](record))
+
+    def close(self):
+        pass
+
+
+# Fields of the events holding ids of agents or tokens
+ID_FIELDS = ['agent', 'sender', 'receiver', 'buyer', 'token', 'owner']
+
+
+class Tracer:
+    # Events are dicts of {'event': name, 'step': step, ...fields}, formatted only by the sinks.
+    # Callers check the level flag before emitting, e.g. `if tracer.debug: tracer.emit(...)`,
+    # so a disabled level costs a single attribute lookup.
+    # With internal (e.g. integer) ids, names(id) gives the name every id is reported by.
+
+    def __init__(self, level=TraceLevel.OFF, sinks=None):
+        self.sinks = sinks if sinks is not None else []
+        self.clock = lambda: None
+        self.names = None
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = TraceLevel(level)
+        self.info = self.level >= TraceLevel.INFO
+        self.debug = self.level >= TraceLevel.DEBUG
+
+    def emit(self, event, **fields):
+        record = {'event': event, 'step': self.clock()}
+        record.update(fields)
+        if self.names is not None:
+            self.name_ids(record)
+        for sink in self.sinks:
+            sink.write(record)
+
+    def name_ids(self, record):
+        names = self.names
+        for field in ID_FIELDS:
+            if field in record:
+                record[field] = names(record[field])
+        if 'agents' in record:
+            record['agents'] = [names(agent_id) for agent_id in record['agents']]
+        if 'tokens' in record:
+            record['tokens'] = [(names(token_id), names(owner)) for token_id, owner in record['tokens']]
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,83 @@
+from typing import Callable, List, Optional
+
+from interfaces import Message, MessageType
+
+
+# Messages of these types are matched by a key taken from them as well
+UPON_KEYS = {
+    # (token_id, version), or for a batched PAY a list of them
+    MessageType.ACK_PAY: lambda msg: msg.content if isinstance(msg.content, tuple) else tuple(msg.content),
+    # The operation id of a pipelined GET_TOKENS (see Agent.pipelined), None otherwise
+    MessageType.ACK_GET_TOKENS: lambda msg: msg.content[2] if len(msg.content) > 2 else None,
+}
+
+
+def get_upon_key(msg: Message):
+    key_func = UPON_KEYS.get(msg.type)
+    return key_func(msg) if key_func is not None else None
+
+
+class Upon:
+    # Waits for upon_amount() messages of msg_type (and key), then func_to_run runs on them
+
+    def __init__(self, func_to_run: Callable, msg_type: MessageType, key, upon_amount: Callable[[], int]):
+        self.func_to_run = func_to_run
+        self.msg_type = msg_type
+        self.key = key
+        self.upon_amount = upon_amount
+        self.msgs = []
+        # Who answered so far
+        self.senders = set()
+
+    def add(self, msg: Message):
+        self.msgs.append(msg)
+        self.senders.add(msg.sender_id)
+
+    def is_ready(self):
+        return len(self.msgs) >= self.upon_amount()
+
+
+class UponRegistry:
+    # Upons indexed by (message type, key), so an incoming message only touches the upons that can match it
+
+    def __init__(self):
+        self.index = {}
+
+    def __len__(self):
+        return sum(len(upons) for upons in self.index.values())
+
+    def __iter__(self):
+        for upons in list(self.index.values()):
+            yield from list(upons)
+
+    def register(self, func_to_run, msg_type: MessageType, upon_amount, key=None) -> Upon:
+        upon = Upon(func_to_run, msg_type, key, upon_amount)
+        self.index.setdefault((msg_type, key), []).append(upon)
+        return upon
+
+    def remove(self, upon: Upon):
+        upons = self.index[(upon.msg_type, upon.key)]
+        upons.remove(upon)
+        if not upons:
+            del self.index[(upon.msg_type, upon.key)]
+
+    def match(self, msg: Message) -> List[Upon]:
+        return self.index.get((msg.type, get_upon_key(msg)), [])
+
+    def receive(self, msg: Message) -> Optional[Upon]:
+        # Add the message to the upons waiting for it.
+        # The first upon that got enough messages is removed and returned, so the caller can run it.
+        for upon in self.match(msg):
+            upon.add(msg)
+            if upon.is_ready():
+                self.remove(upon)
+                return upon
+        return None
+
+    def pop_ready(self) -> Optional[Upon]:
+        # The amounts can change (e.g. when the number of servers changes), so an upon may become ready without a new message
+        for upon in self:
+            if upon.is_ready():
+                self.remove(upon)
+                return upon
+        return None
@@ -0,0 +1,220 @@
+from functools import lru_cache
+import struct
+import uuid
+from typing import List, Tuple
+
+from interfaces import Message, MessageType, Token
+
+# Binary format of the messages, with fixed width fields:
+#   header:    wire version (1 byte), message type (1 byte), flags (1 byte), sender id
+#   receiver:  an id, or with MULTICAST a count (2 bytes) and that many ids
+#   op id:     with HAS_OP_ID, the operation id (8 bytes) ending the content of a pipelined GET_TOKENS or its answer
+#   content:   by message type, see CONTENT_CODECS, or with BATCH (a batched PAY or its ACK) see BATCH_CODECS
+# Ids take 16 bytes: the bytes of a UUID string id, a (small) integer id big endian, or NONE_ID for None.
+# A UUID has its version bits set in its first half, so it never reads back as a small integer.
+# Everything is big endian, and decoding reads through a memoryview without copying the message.
+WIRE_VERSION = 1
+
+HEADER = struct.Struct('!BBB16s')
+COUNT = struct.Struct('!H')
+ID = struct.Struct('!16s')
+OP_ID = struct.Struct('!Q')
+# Token: id, version, owner
+TOKEN = struct.Struct('!16sI16s')
+PAY = struct.Struct('!16s16sI')
+ACK_PAY = struct.Struct('!16sI')
+# GET_TOKENS: owner id and the number of seen sequences, followed by (server id, sequence) pairs
+GET_TOKENS = struct.Struct('!16sH')
+SEEN_SEQ = struct.Struct('!16sQ')
+# Token arrays: the number of tokens, then the tokens. ACK_GET_TOKENS has the DB sequence of the answer before its array
+TOKENS_COUNT = struct.Struct('!I')
+DB_SEQ = struct.Struct('!Q')
+
+MULTICAST = 0x01
+BATCH = 0x02
+HAS_OP_ID = 0x04
+# Types whose content may end with an operation id
+OP_ID_TYPES = (MessageType.GET_TOKENS, MessageType.ACK_GET_TOKENS)
+
+NONE_ID = b'\xff' * 16
+SMALL_INT_LIMIT = 1 << 64
+
+
+@lru_cache(maxsize=1 << 16)
+def encode_id(id) -> bytes:
+    if id is None:
+        return NONE_ID
+    if isinstance(id, int):
+        if not 0 <= id < SMALL_INT_LIMIT:
+            raise ValueError(f'Integer id out of range: {id}')
+        return id.to_bytes(16, 'big')
+    return uuid.UUID(id).bytes
+
+@lru_cache(maxsize=1 << 16)
+def decode_id(data: bytes):
+    if data == NONE_ID:
+        return None
+    value = int.from_bytes(data, 'big')
+    if value < SMALL_INT_LIMIT:
+        return value
+    return str(uuid.UUID(bytes=data))
+
+
+def encode_tokens(tokens: List[Token]) -> bytes:
+    data = bytearray(TOKENS_COUNT.size + TOKEN.size * len(tokens))
+    TOKENS_COUNT.pack_into(data, 0, len(tokens))
+    offset = TOKENS_COUNT.size
+    for token in tokens:
+        TOKEN.pack_into(data, offset, encode_id(token.id), token.version, encode_id(token.owner))
+        offset += TOKEN.size
+    return bytes(data)
+
+def decode_tokens(view: memoryview, offset=0) -> Tuple[List[Token], int]:
+    # The tokens at the offset, and the offset after them
+    count, = TOKENS_COUNT.unpack_from(view, offset)
+    start = offset + TOKENS_COUNT.size
+    end = start + TOKEN.size * count
+    tokens = [Token(decode_id(token_id), version, decode_id(owner))
+              for token_id, version, owner in TOKEN.iter_unpack(view[start:end])]
+    return tokens, end
+
+
+# Content codecs per message type: encode(content) -> bytes, and decode(view, offset) -> content
+def encode_pay(content):
+    token_id, buyer_id, new_version = content
+    return PAY.pack(encode_id(token_id), encode_id(buyer_id), new_version)
+
+def decode_pay(view, offset):
+    token_id, buyer_id, new_version = PAY.unpack_from(view, offset)
+    return decode_id(token_id), decode_id(buyer_id), new_version
+
+def encode_ack_pay(content):
+    token_id, version = content
+    return ACK_PAY.pack(encode_id(token_id), version)
+
+def decode_ack_pay(view, offset):
+    token_id, version = ACK_PAY.unpack_from(view, offset)
+    return decode_id(token_id), version
+
+def encode_get_tokens(content):
+    # Older logs hold just the owner id, which is sent with no seen sequences
+    owner_id, seen_db_seqs = content if isinstance(content, tuple) else (content, {})
+    parts = [GET_TOKENS.pack(encode_id(owner_id), len(seen_db_seqs))]
+    parts += [SEEN_SEQ.pack(encode_id(server_id), seq) for server_id, seq in seen_db_seqs.items()]
+    return b''.join(parts)
+
+def decode_get_tokens(view, offset):
+    owner_id, count = GET_TOKENS.unpack_from(view, offset)
+    start = offset + GET_TOKENS.size
+    seen = view[start:start + SEEN_SEQ.size * count]
+    return decode_id(owner_id), {decode_id(server_id): seq for server_id, seq in SEEN_SEQ.iter_unpack(seen)}
+
+def encode_ack_get_tokens(content):
+    tokens_list, db_seq = content
+    return DB_SEQ.pack(db_seq) + encode_tokens(tokens_list)
+
+def decode_ack_get_tokens(view, offset):
+    db_seq, = DB_SEQ.unpack_from(view, offset)
+    tokens, _ = decode_tokens(view, offset + DB_SEQ.size)
+    return tokens, db_seq
+
+def encode_db_update(content):
+    return encode_tokens(content)
+
+def decode_db_update(view, offset):
+    return decode_tokens(view, offset)[0]
+
+def encode_pay_batch(content):
+    parts = [TOKENS_COUNT.pack(len(content))]
+    parts += [PAY.pack(encode_id(token_id), encode_id(buyer_id), new_version) for token_id, buyer_id, new_version in content]
+    return b''.join(parts)
+
+def decode_pay_batch(view, offset):
+    count, = TOKENS_COUNT.unpack_from(view, offset)
+    start = offset + TOKENS_COUNT.size
+    return [(decode_id(token_id), decode_id(buyer_id), new_version)
+            for token_id, buyer_id, new_version in PAY.iter_unpack(view[start:start + PAY.size * count])]
+
+def encode_ack_pay_batch(content):
+    parts = [TOKENS_COUNT.pack(len(content))]
+    parts += [ACK_PAY.pack(encode_id(token_id), version) for token_id, version in content]
+    return b''.join(parts)
+
+def decode_ack_pay_batch(view, offset):
+    count, = TOKENS_COUNT.unpack_from(view, offset)
+    start = offset + TOKENS_COUNT.size
+    return [(decode_id(token_id), version) for token_id, version in ACK_PAY.iter_unpack(view[start:start + ACK_PAY.size * count])]
+
+def encode_empty(content):
+    return b''
+
+def decode_empty(view, offset):
+    return ()
+
+CONTENT_CODECS = {
+    MessageType.PAY: (encode_pay, decode_pay),
+    MessageType.ACK_PAY: (encode_ack_pay, decode_ack_pay),
+    MessageType.GET_TOKENS: (encode_get_tokens, decode_get_tokens),
+    MessageType.ACK_GET_TOKENS: (encode_ack_get_tokens, decode_ack_get_tokens),
+    MessageType.DB_UPDATE: (encode_db_update, decode_db_update),
+    MessageType.ACK_DB_UPDATE: (encode_empty, decode_empty),
+    MessageType.TURNED_TO_CLIENT: (encode_empty, decode_empty),
+    MessageType.TURNED_TO_SERVER: (encode_empty, decode_empty),
+}
+
+# A batched PAY has a list of entries as content, and its ACK_PAY a list of (token_id, version)
+BATCH_CODECS = {
+    MessageType.PAY: (encode_pay_batch, decode_pay_batch),
+    MessageType.ACK_PAY: (encode_ack_pay_batch, decode_ack_pay_batch),
+}
+
+
+def encode(msg: Message) -> bytes:
+    flags = 0
+    content = msg.content
+    if msg.type in BATCH_CODECS and isinstance(content, list):
+        flags |= BATCH
+        encode_content = BATCH_CODECS[msg.type][0]
+    else:
+        encode_content = CONTENT_CODECS[msg.type][0]
+
+    if isinstance(msg.receiver_id, tuple):
+        flags |= MULTICAST
+        receiver = COUNT.pack(len(msg.receiver_id)) + b''.join(encode_id(receiver_id) for receiver_id in msg.receiver_id)
+    else:
+        receiver = encode_id(msg.receiver_id)
+
+    op_id = b''
+    if msg.type in OP_ID_TYPES and isinstance(content, tuple) and len(content) > 2:
+        flags |= HAS_OP_ID
+        op_id = OP_ID.pack(content[2])
+        content = content[:2]
+    return HEADER.pack(WIRE_VERSION, msg.type.value, flags, encode_id(msg.sender_id)) + receiver + op_id + encode_content(content)
+
+def decode(data) -> Message:
+    view = memoryview(data)
+    version, type_value, flags, sender_id = HEADER.unpack_from(view, 0)
+    if version != WIRE_VERSION:
+        raise ValueError(f'Unsupported wire format version: {version}')
+    msg_type = MessageType(type_value)
+
+    offset = HEADER.size
+    if flags & MULTICAST:
+        count, = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        receiver_id = tuple(decode_id(receiver_id) for receiver_id, in ID.iter_unpack(view[offset:offset + ID.size * count]))
+        offset += ID.size * count
+    else:
+        receiver_id = decode_id(ID.unpack_from(view, offset)[0])
+        offset += ID.size
+
+    op_id = None
+    if flags & HAS_OP_ID:
+        op_id, = OP_ID.unpack_from(view, offset)
+        offset += OP_ID.size
+
+    codecs = BATCH_CODECS if flags & BATCH else CONTENT_CODECS
+    content = codecs[msg_type][1](view, offset)
+    if op_id is not None:
+        content += (op_id,)
+    return Message(msg_type, decode_id(sender_id), receiver_id, content)